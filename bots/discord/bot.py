@@ -2,11 +2,14 @@ import typing
 
 import discord
 
+import constants
 from bots import base
 from bots.discord import client
 
 
 class DiscordBot(base.BaseBot):
+    TYPE = constants.BotType.DISCORD
+
     def __init__(self, api_token: str) -> None:
         super().__init__(api_token)
 
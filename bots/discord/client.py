@@ -1,6 +1,10 @@
 import asyncio
+import dataclasses
 import datetime
+import hashlib
 import logging
+import os
+import time
 import typing
 from functools import partial
 
@@ -8,12 +12,43 @@ import discord
 from discord import app_commands
 from discord import ui
 
+import constants
+import diagnostics
+import metrics
 import models
 import utils
+from bots.discord import reposts
+from bots.discord import rest
+from downloader import base
+from downloader import engine
 from downloader import registry
 
 
+MAX_URLS_PER_MESSAGE = int(os.getenv('MAX_URLS_PER_MESSAGE') or 5)
+MAX_ATTACHMENTS_PER_MESSAGE = 10
+MAX_CONTENT_LENGTH = 2000
+DEFAULT_FILESIZE_LIMIT = 25 * 1024 * 1024
+DELETE_TIMEOUT = 300
+# Reposts whose attachment links take more than this are downloaded again, leaving room for the header and description
+MAX_REPOST_LINKS_LENGTH = MAX_CONTENT_LENGTH // 2
+PROGRESSIVE_REPLY = (os.getenv('PROGRESSIVE_REPLY') or 'true').lower() == 'true'
+PREVIEW_FOOTER = '⏳ Fetching media...'
+
+
+@dataclasses.dataclass
+class Job:
+    url: str
+    client: typing.Optional[base.BaseClient] = None
+    post: typing.Optional[models.Post] = None
+    repost: typing.Optional[discord.Message] = None
+    repost_description: typing.Optional[str] = None
+    error: typing.Optional[Exception] = None
+
+
 class CustomView(ui.View):
+    def __init__(self, timeout: typing.Optional[float] = DELETE_TIMEOUT) -> None:
+        super().__init__(timeout=timeout)
+
     @ui.button(label='❌')
     async def on_click(
         self,
@@ -21,7 +56,10 @@ class CustomView(ui.View):
         button: ui.Button,
     ) -> None:
         if interaction.user.mentioned_in(interaction.message):
-            await interaction.message.delete()
+            await interaction.client.rest.call(
+                'message.delete', interaction.message.channel.id, interaction.message.delete
+            )
+            interaction.client.reposts.invalidate(message_id=interaction.message.id)
             logging.info(f'User {interaction.user.id} performed a delete action')
         else:
             logging.warning(
@@ -29,10 +67,98 @@ class CustomView(ui.View):
             )
 
 
+class PlaceholderSender(object):
+    """
+    Edits the placeholder message into the first result and sends any further results as new messages.
+    Until then the placeholder can show a preview of the metadata. Previews are coalesced so that at most one edit
+    is in flight and only the newest pending one follows it, and none are sent once the result is waiting.
+    """
+
+    def __init__(self, scheduler: rest.RestScheduler, placeholder: discord.Message, started: float) -> None:
+        self.scheduler = scheduler
+        self.placeholder = placeholder
+        self.started = started
+        self._placeholder_used = False
+        self._responded = False
+        self._result_pending = False
+        self._lock = asyncio.Lock()
+        self._pending_preview: typing.Optional[str] = None
+        self._preview_task: typing.Optional[asyncio.Task] = None
+
+    def preview(self, content: str) -> None:
+        if self._result_pending:
+            return
+
+        self._pending_preview = content
+        if not self._preview_task:
+            self._preview_task = asyncio.create_task(self._send_previews())
+
+    async def __call__(
+        self,
+        content: str,
+        files: typing.Optional[typing.List[discord.File]] = None,
+        suppress_embeds: bool = True,
+    ) -> discord.Message:
+        channel = self.placeholder.channel
+        self._result_pending = True
+        self._pending_preview = None
+        async with self._lock:
+            if not self._placeholder_used:
+                msg = await self.scheduler.call(
+                    'message.edit',
+                    channel.id,
+                    self.placeholder.edit,
+                    content=content,
+                    attachments=files or [],
+                    suppress=suppress_embeds,
+                    view=CustomView(),
+                )
+                self._placeholder_used = True
+                self._record_response()
+                metrics.observe('discord.time_to_full_response', time.monotonic() - self.started)
+                return msg
+
+        return await self.scheduler.call(
+            'message.send',
+            channel.id,
+            channel.send,
+            content=content,
+            files=files or [],
+            suppress_embeds=suppress_embeds,
+            view=CustomView(),
+        )
+
+    async def _send_previews(self) -> None:
+        try:
+            while self._pending_preview is not None and not self._result_pending:
+                content, self._pending_preview = self._pending_preview, None
+                async with self._lock:
+                    await self.scheduler.call(
+                        'message.edit',
+                        self.placeholder.channel.id,
+                        self.placeholder.edit,
+                        content=content,
+                        suppress=True,
+                    )
+                self._record_response()
+        except discord.HTTPException as e:
+            logging.error(f'Failed editing preview into {self.placeholder.id}: {str(e)}')
+        finally:
+            self._preview_task = None
+
+    def _record_response(self) -> None:
+        if not self._responded:
+            self._responded = True
+            metrics.observe('discord.time_to_first_response', time.monotonic() - self.started)
+
+
 class DiscordClient(discord.Client):
     def __init__(self, *, intents: discord.Intents, **options: typing.Any) -> None:
+        options.setdefault('max_ratelimit_timeout', rest.MAX_RATELIMIT_TIMEOUT)
         super().__init__(intents=intents, **options)
 
+        self.rest = rest.RestScheduler()
+        self.reposts = reposts.RepostIndex()
         self.tree = app_commands.CommandTree(client=self)
         self.tree.add_command(
             app_commands.Command(
@@ -43,46 +169,68 @@ class DiscordClient(discord.Client):
         )
 
     async def on_ready(self):
+        registry.start_warm_up()
         await self.tree.sync()
         logging.info(f'Logged on as {self.user}')
 
     async def on_message(self, message: discord.Message):
+        started = time.monotonic()
         if message.author == self.user:
             return
 
-        url = utils.find_first_url(message.content)
-        if not url:
-            return
-
-        try:
-            client = registry.get_instance(url=url)
-        except Exception as e:
-            logging.error(f'Failed to obtain a strategy for url {url}. Error: {str(e)}')
+        urls = registry.find_supported_urls(message.content)[:MAX_URLS_PER_MESSAGE]
+        if not urls:
             return
 
-        new_message = (await asyncio.gather(message.delete(), message.channel.send('🔥 Working on it 🥵')))[1]
+        async with diagnostics.job(url=' '.join(urls)):
+            await self._handle_message(message=message, urls=urls, started=started)
 
-        try:
-            post = await client.get_post()
-        except Exception as e:
-            logging.error(f'Failed downloading {url}: {str(e)}')
+    async def _handle_message(self, message: discord.Message, urls: typing.List[str], started: float) -> None:
+        channel_id = message.channel.id
+        new_message = (
             await asyncio.gather(
-                new_message.edit(content=f'Failed downloading {url}. {message.author.mention}'),
-                new_message.add_reaction('❌'),
+                self.rest.call('message.delete', channel_id, message.delete),
+                self.rest.call(
+                    'message.send', channel_id, message.channel.send, f'🔥 Working on it 🥵 {message.author.mention}'
+                ),
             )
-            raise e
+        )[1]
+        sender = PlaceholderSender(scheduler=self.rest, placeholder=new_message, started=started)
+        previews: typing.Dict[str, models.Post] = {}
+
+        async def on_metadata(url: str, post: models.Post) -> None:
+            previews[url] = post
+            sender.preview(content=self._preview_content(urls=urls, previews=previews, author=message.author))
+
+        jobs = await asyncio.gather(
+            *(
+                self._run_job(
+                    url=url,
+                    spoiler=False,
+                    on_metadata=partial(on_metadata, url) if PROGRESSIVE_REPLY else None,
+                )
+                for url in urls
+            )
+        )
+        if all(job.error for job in jobs):
+            await sender(content=f'Failed downloading {", ".join(urls)}. {message.author.mention}')
+            return
 
         try:
-            msg = await self._send_post(post=post, send_func=message.channel.send, author=message.author)
-            logging.info(f'User {message.author.display_name} sent message with url {url}')
+            await self._send_jobs(
+                jobs=jobs,
+                send_func=sender,
+                author=message.author,
+                size_limit=message.guild.filesize_limit if message.guild else DEFAULT_FILESIZE_LIMIT,
+            )
+            logging.info(f'User {message.author.display_name} sent message with urls {", ".join(urls)}')
         except Exception as e:
-            logging.error(f'Failed sending message {url}: {str(e)}')
-            msg = await message.channel.send(
-                content=f'Failed sending discord message for {url} ({message.author.mention}).\nError: {str(e)}'
+            logging.error(f'Failed sending message {", ".join(urls)}: {str(e)}')
+            await sender(
+                content=f'Failed sending discord message for {", ".join(urls)} ({message.author.mention}).\n'
+                f'Error: {str(e)}'
             )
 
-        await asyncio.gather(msg.add_reaction('❌'), new_message.delete())
-
     async def on_reaction_add(self, reaction: discord.Reaction, user: discord.User):
         if (
             reaction.message.author.id == self.user.id
@@ -92,68 +240,314 @@ class DiscordClient(discord.Client):
             >= (datetime.datetime.utcnow() - datetime.timedelta(minutes=5))
         ):
             logging.info(f'User {user.display_name} deleted message {utils.find_first_url(reaction.message.content)}')
-            await reaction.message.delete()
+            await self.rest.call('message.delete', reaction.message.channel.id, reaction.message.delete)
+            self.reposts.invalidate(message_id=reaction.message.id)
 
     async def command_embed(self, interaction: discord.Interaction, url: str, spoiler: bool = False) -> None:
         await interaction.response.defer()
 
-        try:
-            client = registry.get_instance(url=url)
-        except Exception as e:
-            logging.error(f'Failed to obtain a strategy for url {url}. Error: {str(e)}')
+        async with diagnostics.job(url=url):
+            await self._handle_command(interaction=interaction, url=url, spoiler=spoiler)
+
+    async def _handle_command(self, interaction: discord.Interaction, url: str, spoiler: bool) -> None:
+        job = await self._run_job(url=url, spoiler=spoiler)
+        if job.error:
+            await self.rest.call(
+                'interaction.followup',
+                interaction.channel_id,
+                interaction.followup.send,
+                f'Failed fetching {url} ({interaction.user.mention}).\nError: {job.error}',
+            )
             return
 
+        await self._send_jobs(
+            jobs=[job],
+            send_func=partial(
+                self.rest.call,
+                'interaction.followup',
+                interaction.channel_id,
+                interaction.followup.send,
+                view=CustomView(),
+            ),
+            author=interaction.user,
+            size_limit=interaction.guild.filesize_limit if interaction.guild else DEFAULT_FILESIZE_LIMIT,
+        )
+
+    async def _run_job(
+        self,
+        url: str,
+        spoiler: bool,
+        on_metadata: typing.Optional[typing.Callable[[models.Post], typing.Awaitable[None]]] = None,
+    ) -> Job:
+        job = Job(url=url)
         try:
-            post = await client.get_post()
-            if not post.spoiler:
-                post.spoiler = spoiler
+            job.client = registry.get_instance(url=url)
+            job.client.on_metadata = on_metadata
+
+            with diagnostics.stage('repost_lookup'):
+                repost = await self._find_repost(client=job.client, spoiler=spoiler)
+            if repost:
+                job.repost, job.repost_description = repost
+                return job
+
+            job.post = await engine.get_post(client=job.client)
+            if not job.post.spoiler:
+                job.post.spoiler = spoiler
         except Exception as e:
             logging.error(f'Failed downloading {url}: {str(e)}')
-            await interaction.followup.send(f'Failed fetching {url} ({interaction.user.mention}).\nError: {str(e)}')
-            raise e
+            job.error = e
 
-        await self._send_post(
-            post=post,
-            send_func=partial(interaction.followup.send, view=CustomView()),
-            author=interaction.user,
-        )
+        return job
 
-    async def _send_post(
+    async def _find_repost(
         self,
-        post: models.Post,
-        send_func: typing.Callable,
+        client: base.BaseClient,
+        spoiler: bool,
+    ) -> typing.Optional[typing.Tuple[discord.Message, str]]:
+        post_id = client.canonical_id
+        if not post_id:
+            return None
+
+        repost = self.reposts.get(post_id=post_id)
+        if not repost or (spoiler and not repost.spoiler):
+            return None
+        if not repost.description:  # Indexed before descriptions were stored
+            self.reposts.invalidate(message_id=repost.message_id)
+            return None
+
+        try:
+            channel = self.get_channel(repost.channel_id) or await self.rest.call(
+                'channel.fetch', repost.channel_id, self.fetch_channel, repost.channel_id
+            )
+            message = await self.rest.call('message.fetch', repost.channel_id, channel.fetch_message, repost.message_id)
+        except (discord.NotFound, discord.Forbidden):
+            self.reposts.invalidate(message_id=repost.message_id)
+            return None
+        except discord.HTTPException as e:
+            logging.warning(f'Failed fetching repost {repost.message_id}, downloading again: {str(e)}')
+            return None
+
+        attachments = _job_attachments(post_id=post_id, message=message)
+        if not attachments:
+            self.reposts.invalidate(message_id=repost.message_id)
+            return None
+        if len(_attachment_links(attachments=attachments)) > MAX_REPOST_LINKS_LENGTH:
+            return None
+
+        return message, repost.description
+
+    def _index_repost(self, job: Job, message: discord.Message) -> None:
+        post_id = job.client.canonical_id
+        if (
+            post_id
+            and message
+            and job.client.tier == constants.DegradationTier.FULL
+            and _job_attachments(post_id=post_id, message=message)
+        ):
+            self.reposts.add(
+                post_id=post_id,
+                message=message,
+                spoiler=job.post.spoiler,
+                description=str(job.post).rstrip('\n'),
+            )
+
+    def _job_content(self, job: Job, max_length: int) -> str:
+        if job.error:
+            return f'Failed downloading {job.url}.'
+
+        if job.repost:
+            links = _attachment_links(attachments=_job_attachments(post_id=job.client.canonical_id, message=job.repost))
+            description = job.repost_description
+            if len(description) > max_length - len(links) - 1:
+                description = description[: max(max_length - len(links) - 4, 0)] + '...'
+            return f'{description}\n{links}'
+
+        content = str(job.post)
+        if len(content) > max_length:
+            if job.post.spoiler:
+                content = content[: max_length - 5] + '||...'
+            else:
+                content = content[: max_length - 3] + '...'
+        return content
+
+    def _preview_content(
+        self,
+        urls: typing.List[str],
+        previews: typing.Dict[str, models.Post],
         author: discord.User,
-    ) -> discord.Message:
-        send_kwargs = {
-            'suppress_embeds': True,
-        }
-        file = None
-        if post.buffer:
-            extension = utils.guess_extension_from_buffer(buffer=post.buffer)
-            file = discord.File(
-                fp=post.buffer,
-                filename='{spoiler}file{extension}'.format(
-                    spoiler='SPOILER_' if post.spoiler else '',
-                    extension=extension,
+    ) -> str:
+        header = _header(author=author)
+        max_length = MAX_CONTENT_LENGTH - len(header) - len(PREVIEW_FOOTER) - 1
+
+        content = '\n'.join(
+            self._job_content(job=Job(url=url, post=previews[url]), max_length=max_length)
+            for url in urls
+            if url in previews
+        )
+        if len(content) > max_length:
+            content = content[: max_length - 3] + '...'
+        return f'{header}{content}\n{PREVIEW_FOOTER}'
+
+    def _job_files(self, job: Job) -> typing.List[discord.File]:
+        if not job.post:
+            return []
+
+        return [
+            discord.File(
+                fp=buffer,
+                filename='{spoiler}file_{tag}_{index}{extension}'.format(
+                    spoiler='SPOILER_' if job.post.spoiler else '',
+                    tag=_attachment_tag(post_id=job.client.canonical_id),
+                    index=i,
+                    extension=utils.guess_extension_from_buffer(buffer=buffer),
                 ),
             )
-            send_kwargs['file'] = file
+            for i, buffer in enumerate(job.post.buffers)
+        ]
+
+    async def _send_jobs(
+        self,
+        jobs: typing.List[Job],
+        send_func: typing.Callable,
+        author: discord.User,
+        size_limit: int,
+    ) -> typing.List[discord.Message]:
+        for job in jobs:
+            if job.post and job.post.buffers:
+                for buffer in job.post.buffers[MAX_ATTACHMENTS_PER_MESSAGE:]:
+                    buffer.close()
+                with diagnostics.stage('resize'):
+                    job.post.buffers = await utils.fit_to_budget(
+                        buffers=job.post.buffers[:MAX_ATTACHMENTS_PER_MESSAGE],
+                        budget=size_limit,
+                        allow_resize=job.client.tier < constants.DegradationTier.NO_REENCODE,
+                    )
+
+        max_length = MAX_CONTENT_LENGTH - len(_header(author=author))
+        batches: typing.List[typing.List[Job]] = []
+        batch_content = batch_files = batch_size = 0
+        for job in jobs:
+            content_length = len(self._job_content(job=job, max_length=max_length)) + 1
+            buffers = job.post.buffers if job.post else []
+            files = len(buffers)
+            size = sum(utils.buffer_size(buffer) for buffer in buffers)
+            if (
+                not batches
+                or batch_content + content_length > max_length
+                or batch_files + files > MAX_ATTACHMENTS_PER_MESSAGE
+                or batch_size + size > size_limit
+            ):
+                batches.append([])
+                batch_content = batch_files = batch_size = 0
+
+            batches[-1].append(job)
+            batch_content += content_length
+            batch_files += files
+            batch_size += size
 
+        msgs = []
         try:
-            content = f'Here you go {author.mention} {utils.random_emoji()}.\n{str(post)}'
-            if len(content) > 2000:
-                if post.spoiler:
-                    content = content[:1995] + '||...'
-                else:
-                    content = content[:1997] + '...'
+            for batch in batches:
+                try:
+                    msgs.extend(await self._send_batch(jobs=batch, send_func=send_func, author=author))
+                finally:
+                    for job in batch:
+                        _close_buffers(job=job)
+        finally:
+            for job in jobs:
+                _close_buffers(job=job)
+        return msgs
 
-            send_kwargs['content'] = content
+    async def _send_batch(
+        self,
+        jobs: typing.List[Job],
+        send_func: typing.Callable,
+        author: discord.User,
+    ) -> typing.List[discord.Message]:
+        header = _header(author=author)
+        max_length = MAX_CONTENT_LENGTH - len(header)
+
+        files = [file for job in jobs for file in self._job_files(job=job)]
 
-            return await send_func(**send_kwargs)
+        content = '\n'.join(self._job_content(job=job, max_length=max_length) for job in jobs)
+        if len(content) > max_length:
+            content = content[: max_length - 3] + '...'
+
+        try:
+            with diagnostics.stage('upload'):
+                msg = await send_func(
+                    content=f'{header}{content}',
+                    files=files,
+                    suppress_embeds=not any(job.repost for job in jobs),
+                )
         except discord.HTTPException as e:
             if e.status != 413:  # Payload too large
                 raise e
-            logging.info('File too large, resizing...')
-            file.fp.seek(0)
-            post.buffer = await utils.resize(buffer=file.fp, extension=extension)
-            return await self._send_post(post=post, send_func=send_func, author=author)
+
+            for file in files:
+                file.fp.seek(0)
+
+            if len(jobs) > 1:
+                logging.info('Batch too large, sending posts separately...')
+                msgs = []
+                for job in jobs:
+                    msgs.extend(await self._send_batch(jobs=[job], send_func=send_func, author=author))
+                return msgs
+
+            with diagnostics.stage('resize'):
+                await self._shrink_job(job=jobs[0])
+            return await self._send_batch(jobs=jobs, send_func=send_func, author=author)
+
+        for job in jobs:
+            if job.post:
+                self._index_repost(job=job, message=msg)
+
+        return [msg]
+
+    @staticmethod
+    async def _shrink_job(job: Job) -> None:
+        post = job.post
+        if job.client.tier >= constants.DegradationTier.NO_REENCODE:
+            logging.info('File too large, sending without media...')
+            _close_buffers(job=job)
+            post.buffers = []
+            return
+
+        logging.info('File too large, resizing...')
+        buffers = post.buffers
+        largest = max(range(len(buffers)), key=lambda i: utils.buffer_size(buffers[i]))
+        original = buffers[largest]
+        buffers[largest] = await utils.resize(
+            buffer=original,
+            extension=utils.guess_extension_from_buffer(buffer=original),
+        )
+        original.close()
+        post.buffers = buffers
+
+
+def _header(author: discord.User) -> str:
+    return f'Here you go {author.mention} {utils.random_emoji()}.\n'
+
+
+def _attachment_links(attachments: typing.List[discord.Attachment]) -> str:
+    return '\n'.join(
+        f'||{attachment.url}||' if attachment.is_spoiler() else attachment.url for attachment in attachments
+    )
+
+
+def _close_buffers(job: Job) -> None:
+    """
+    Media is charged to the memory accountant until closed, discord.File leaves buffers in a reference cycle otherwise.
+    """
+    if job.post:
+        for buffer in job.post.buffers:
+            buffer.close()
+
+
+def _attachment_tag(post_id: typing.Optional[str]) -> str:
+    return hashlib.sha1((post_id or '').encode()).hexdigest()[:8]
+
+
+def _job_attachments(post_id: str, message: discord.Message) -> typing.List[discord.Attachment]:
+    tag = _attachment_tag(post_id=post_id)
+    return [attachment for attachment in message.attachments if f'_{tag}_' in attachment.filename]
@@ -0,0 +1,73 @@
+import dataclasses
+import os
+import sqlite3
+import time
+import typing
+
+import discord
+
+
+REPOST_INDEX_PATH = os.getenv('REPOST_INDEX_PATH') or 'reposts.sqlite3'
+
+
+@dataclasses.dataclass
+class Repost:
+    post_id: str
+    channel_id: int
+    message_id: int
+    spoiler: bool
+    created: float
+    description: str
+
+
+class RepostIndex(object):
+    """
+    Persistent mapping of canonical post ids to the discord messages that already carry their attachments.
+    """
+
+    def __init__(self, path: str = REPOST_INDEX_PATH) -> None:
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS reposts ('
+            'post_id TEXT PRIMARY KEY, '
+            'channel_id INTEGER NOT NULL, '
+            'message_id INTEGER NOT NULL, '
+            'spoiler INTEGER NOT NULL, '
+            'created REAL NOT NULL, '
+            "description TEXT NOT NULL DEFAULT ''"
+            ')'
+        )
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(reposts)')}
+        if 'description' not in columns:
+            self._conn.execute("ALTER TABLE reposts ADD COLUMN description TEXT NOT NULL DEFAULT ''")
+        self._conn.execute('CREATE INDEX IF NOT EXISTS reposts_message_id ON reposts (message_id)')
+        self._conn.commit()
+
+    def get(self, post_id: str) -> typing.Optional[Repost]:
+        row = self._conn.execute(
+            'SELECT post_id, channel_id, message_id, spoiler, created, description FROM reposts WHERE post_id = ?',
+            (post_id,),
+        ).fetchone()
+        if not row:
+            return None
+
+        return Repost(
+            post_id=row[0],
+            channel_id=row[1],
+            message_id=row[2],
+            spoiler=bool(row[3]),
+            created=row[4],
+            description=row[5],
+        )
+
+    def add(self, post_id: str, message: discord.Message, spoiler: bool, description: str) -> None:
+        self._conn.execute(
+            'INSERT OR REPLACE INTO reposts (post_id, channel_id, message_id, spoiler, created, description) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (post_id, message.channel.id, message.id, int(spoiler), time.time(), description),
+        )
+        self._conn.commit()
+
+    def invalidate(self, message_id: int) -> None:
+        self._conn.execute('DELETE FROM reposts WHERE message_id = ?', (message_id,))
+        self._conn.commit()
@@ -0,0 +1,46 @@
+import asyncio
+import collections
+import logging
+import os
+import typing
+
+import discord
+
+import metrics
+
+
+ROUTE_CONCURRENCY = int(os.getenv('DISCORD_ROUTE_CONCURRENCY') or 2)
+# Lowest value discord.py accepts, shorter rate limits are always waited out inside discord.py
+MAX_RATELIMIT_TIMEOUT = 30.0
+
+
+class RestScheduler(object):
+    """
+    Limits concurrent discord REST calls per route and channel and counts calls per route. Rate limits longer than
+    MAX_RATELIMIT_TIMEOUT block the route and channel until they expire, without holding a slot while waiting.
+    """
+
+    def __init__(self, concurrency: int = ROUTE_CONCURRENCY) -> None:
+        self._semaphores: typing.DefaultDict[typing.Tuple[str, int], asyncio.Semaphore] = collections.defaultdict(
+            lambda: asyncio.Semaphore(concurrency)
+        )
+        self._blocked_until: typing.Dict[typing.Tuple[str, int], float] = {}
+
+    async def call(self, route: str, channel_id: int, func: typing.Callable, *args, **kwargs) -> typing.Any:
+        key = (route, channel_id)
+        loop = asyncio.get_running_loop()
+        metrics.increment(f'discord.rest.{route}')
+
+        while True:
+            delay = self._blocked_until.get(key, 0) - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            async with self._semaphores[key]:
+                try:
+                    return await func(*args, **kwargs)
+                except discord.RateLimited as e:
+                    logging.warning(f'Discord route {route} rate limited for {e.retry_after}s, retrying...')
+                    metrics.increment(f'discord.rest.{route}.rate_limited')
+                    self._blocked_until[key] = max(self._blocked_until.get(key, 0), loop.time() + e.retry_after)
@@ -0,0 +1,198 @@
+import asyncio
+import hmac
+import json
+import logging
+import mimetypes
+import os
+import typing
+import uuid
+
+from aiohttp import web
+
+import diagnostics
+import metrics
+import models
+import utils
+from downloader import engine
+from downloader import registry
+
+
+MAX_BATCH_URLS = int(os.getenv('HTTP_API_MAX_BATCH_URLS') or 20)
+CHUNK_SIZE = 64 * 1024
+
+
+class Result(typing.NamedTuple):
+    url: str
+    post: typing.Optional[models.Post] = None
+    error: typing.Optional[str] = None
+
+
+def create_app(api_token: str) -> web.Application:
+    @web.middleware
+    async def authenticate(request: web.Request, handler: typing.Callable) -> web.StreamResponse:
+        if request.path != '/health' and not hmac.compare_digest(
+            request.headers.get('Authorization', ''), f'Bearer {api_token}'
+        ):
+            raise web.HTTPUnauthorized()
+        return await handler(request)
+
+    app = web.Application(middlewares=[authenticate])
+    app.add_routes(
+        [
+            web.get('/health', health),
+            web.get('/metrics', metrics_snapshot),
+            web.get('/embed', embed),
+            web.post('/batch', batch),
+        ]
+    )
+    return app
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.json_response({'platforms': registry.READINESS})
+
+
+async def metrics_snapshot(request: web.Request) -> web.Response:
+    return web.json_response(metrics.snapshot())
+
+
+async def embed(request: web.Request) -> web.StreamResponse:
+    url = request.query.get('url')
+    if not url:
+        raise web.HTTPBadRequest(text='Missing url parameter')
+    if not registry.is_supported(url):
+        raise web.HTTPBadRequest(text=f'Unsupported url {url}')
+
+    result = await _fetch(url=url, spoiler=request.query.get('spoiler') == 'true')
+    if result.error:
+        return web.json_response({'url': url, 'error': result.error}, status=502)
+
+    try:
+        response, boundary = await _prepare_multipart(request=request)
+        await _write_result(response=response, boundary=boundary, result=result)
+        return await _finish_multipart(response=response, boundary=boundary)
+    finally:
+        _close_buffers(result=result)
+
+
+async def batch(request: web.Request) -> web.StreamResponse:
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text='Invalid JSON body')
+
+    urls = body.get('urls') if isinstance(body, dict) else None
+    if not isinstance(urls, list) or not urls or not all(isinstance(url, str) for url in urls):
+        raise web.HTTPBadRequest(text='Body must contain a non-empty list of urls')
+    if len(urls) > MAX_BATCH_URLS:
+        raise web.HTTPBadRequest(text=f'At most {MAX_BATCH_URLS} urls are allowed per batch')
+    unsupported = [url for url in urls if not registry.is_supported(url)]
+    if unsupported:
+        raise web.HTTPBadRequest(text=f'Unsupported urls {", ".join(unsupported)}')
+
+    spoiler = bool(body.get('spoiler', False))
+    tasks = [asyncio.create_task(_fetch(url=url, spoiler=spoiler)) for url in urls]
+    try:
+        response, boundary = await _prepare_multipart(request=request)
+        for future in asyncio.as_completed(tasks):
+            await _write_result(response=response, boundary=boundary, result=await future)
+        return await _finish_multipart(response=response, boundary=boundary)
+    finally:
+        # The client may have disconnected, release whatever was not streamed
+        for task in tasks:
+            task.cancel()
+            if task.done() and not task.cancelled():
+                _close_buffers(result=task.result())
+
+
+async def _fetch(url: str, spoiler: bool) -> Result:
+    async with diagnostics.job(url=url):
+        try:
+            post = await engine.get_post(client=registry.get_instance(url=url))
+        except Exception as e:
+            logging.error(f'Failed downloading {url}: {str(e)}')
+            return Result(url=url, error=str(e))
+
+    if not post.spoiler:
+        post.spoiler = spoiler
+    return Result(url=url, post=post)
+
+
+def _close_buffers(result: Result) -> None:
+    if result.post:
+        for buffer in result.post.buffers:
+            buffer.close()
+
+
+async def _prepare_multipart(request: web.Request) -> typing.Tuple[web.StreamResponse, str]:
+    """
+    Results are streamed as multipart/mixed, each one as a JSON metadata part followed by one part per attachment.
+    """
+    boundary = uuid.uuid4().hex
+    response = web.StreamResponse(headers={'Content-Type': f'multipart/mixed; boundary={boundary}'})
+    await response.prepare(request)
+    return response, boundary
+
+
+async def _finish_multipart(response: web.StreamResponse, boundary: str) -> web.StreamResponse:
+    await response.write(f'--{boundary}--\r\n'.encode())
+    await response.write_eof()
+    return response
+
+
+async def _write_result(response: web.StreamResponse, boundary: str, result: Result) -> None:
+    if result.error:
+        metadata = {'url': result.url, 'error': result.error}
+        await _write_part(response=response, boundary=boundary, content_type='application/json', body=metadata)
+        return
+
+    post = result.post
+    buffers = post.buffers
+    extensions = [utils.guess_extension_from_buffer(buffer=buffer) for buffer in buffers]
+    filenames = [f'file_{i}{extension}' for i, extension in enumerate(extensions)]
+    metadata = {
+        'url': result.url,
+        'post': {
+            'url': post.url,
+            'author': str(post.author) if post.author else None,
+            'description': post.description,
+            'views': post.views,
+            'likes': post.likes,
+            'spoiler': post.spoiler,
+            'created': post.created.isoformat() if post.created else None,
+            'text': str(post),
+        },
+        'attachments': filenames,
+    }
+    await _write_part(response=response, boundary=boundary, content_type='application/json', body=metadata)
+
+    for buffer, extension, filename in zip(buffers, extensions, filenames):
+        await _write_part(
+            response=response,
+            boundary=boundary,
+            content_type=mimetypes.types_map.get(extension, 'application/octet-stream'),
+            body=buffer,
+            filename=filename,
+        )
+        buffer.close()
+
+
+async def _write_part(
+    response: web.StreamResponse,
+    boundary: str,
+    content_type: str,
+    body: typing.Union[typing.Dict, typing.BinaryIO],
+    filename: typing.Optional[str] = None,
+) -> None:
+    headers = f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+    if filename:
+        headers += f'Content-Disposition: attachment; filename="{filename}"\r\n'
+    await response.write(f'{headers}\r\n'.encode())
+
+    if isinstance(body, dict):
+        await response.write(json.dumps(body).encode())
+    else:
+        while chunk := body.read(CHUNK_SIZE):
+            await response.write(chunk)
+
+    await response.write(b'\r\n')
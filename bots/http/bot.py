@@ -0,0 +1,37 @@
+import asyncio
+import logging
+import os
+import typing
+
+from aiohttp import web
+
+import constants
+from bots import base
+from bots.http import app
+from downloader import registry
+
+
+HTTP_API_HOST = os.getenv('HTTP_API_HOST') or '127.0.0.1'
+HTTP_API_PORT = int(os.getenv('HTTP_API_PORT') or 8080)
+
+
+class HttpBot(base.BaseBot):
+    TYPE = constants.BotType.HTTP
+
+    def __init__(self, api_token: str, host: str = HTTP_API_HOST, port: int = HTTP_API_PORT) -> None:
+        super().__init__(api_token)
+
+        self.host = host
+        self.port = port
+
+    async def run(self) -> typing.NoReturn:
+        runner = web.AppRunner(app.create_app(api_token=self.api_token))
+        await runner.setup()
+        await web.TCPSite(runner=runner, host=self.host, port=self.port).start()
+        registry.start_warm_up()
+        logging.info(f'HTTP API listening on {self.host}:{self.port}')
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
@@ -1,15 +1,46 @@
+import asyncio
 import os
 import typing
 
-from bots.discord import bot
+import diagnostics
+import metrics
+from bots import base
+from bots.discord import bot as discord_bot
+from bots.http import bot as http_bot
+from downloader import engine
+
+
+_background_tasks: typing.Set[asyncio.Task] = set()
 
 
 async def run_strategies() -> typing.NoReturn:
     """
-    TODO: Add support for multiple strategies and move env vars to settings/config
+    Runs every bot front-end with a token configured. TODO: Move env vars to settings/config
     """
+    metrics_interval = os.environ.get('METRICS_LOG_INTERVAL')
+    if metrics_interval:
+        _background_tasks.add(asyncio.create_task(metrics.report_forever(interval=float(metrics_interval))))
+
+    if engine.DEGRADATION:
+        _background_tasks.add(asyncio.create_task(engine.shedder.run()))
+
+    monitor = diagnostics.start()
+    if monitor:
+        _background_tasks.add(monitor)
+
+    bots: typing.List[base.BaseBot] = []
+
     discord_api_key = os.environ.get('DISCORD_API_TOKEN')
     if discord_api_key:
-        await bot.DiscordBot(api_token=discord_api_key).run()
-    else:
-        raise RuntimeError('DISCORD_API_TOKEN environment variable not set, plesae set it to a valid value.')
+        bots.append(discord_bot.DiscordBot(api_token=discord_api_key))
+
+    http_api_token = os.environ.get('HTTP_API_TOKEN')
+    if http_api_token:
+        bots.append(http_bot.HttpBot(api_token=http_api_token))
+
+    if not bots:
+        raise RuntimeError(
+            'Neither DISCORD_API_TOKEN nor HTTP_API_TOKEN environment variable is set, plesae set at least one of them.'
+        )
+
+    await asyncio.gather(*(bot.run() for bot in bots))
@@ -3,3 +3,12 @@ import enum
 
 class BotType(enum.Enum):
     DISCORD = 'discord'
+    HTTP = 'http'
+
+
+class DegradationTier(enum.IntEnum):
+    FULL = 0
+    LOW_BITRATE = 1
+    NO_REENCODE = 2
+    IMAGE_ALBUM = 3
+    METADATA_ONLY = 4
@@ -0,0 +1,165 @@
+import asyncio
+import cProfile
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import typing
+import weakref
+
+import metrics
+
+
+DIAGNOSTICS = (os.getenv('DIAGNOSTICS') or 'false').lower() == 'true'
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL') or 0.1)
+BLOCKING_THRESHOLD = float(os.getenv('BLOCKING_THRESHOLD') or 0.5)
+SLOW_JOB_SECONDS = float(os.getenv('SLOW_JOB_SECONDS') or 30)
+
+
+@dataclasses.dataclass
+class JobInfo:
+    url: str
+    platform: typing.Optional[str] = None
+    started: float = dataclasses.field(default_factory=time.monotonic)
+    stages: typing.DefaultDict[str, float] = dataclasses.field(default_factory=lambda: collections.defaultdict(float))
+
+
+_current_job: contextvars.ContextVar[typing.Optional[JobInfo]] = contextvars.ContextVar('current_job', default=None)
+_jobs: 'weakref.WeakKeyDictionary[asyncio.Task, JobInfo]' = weakref.WeakKeyDictionary()
+_profiled_job: typing.Optional[JobInfo] = None
+
+
+class LoopMonitor(object):
+    """
+    Measures event loop lag and samples the loop thread's stack whenever a callback blocks it past the threshold.
+    """
+
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL, threshold: float = BLOCKING_THRESHOLD) -> None:
+        self.interval = interval
+        self.threshold = threshold
+        self._heartbeat = time.monotonic()
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread_id: typing.Optional[int] = None
+
+    async def run(self) -> typing.NoReturn:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+
+        while True:
+            start = self._loop.time()
+            await asyncio.sleep(self.interval)
+            lag = self._loop.time() - start - self.interval
+            self._heartbeat = time.monotonic()
+            metrics.gauge('loop.lag_seconds', lag)
+            metrics.observe('loop.lag', lag)
+
+    def _watch(self) -> typing.NoReturn:
+        reported = False
+        while True:
+            time.sleep(self.threshold / 2)
+            blocked = time.monotonic() - self._heartbeat - self.interval
+            if blocked < self.threshold:
+                reported = False
+            elif not reported:
+                reported = True
+                self._report(blocked=blocked)
+
+    def _report(self, blocked: float) -> None:
+        metrics.increment('loop.blocked')
+
+        frame = sys._current_frames().get(self._loop_thread_id)
+        stack = ''.join(traceback.format_stack(frame)) if frame else '<unavailable>'
+        try:
+            task = asyncio.current_task(loop=self._loop)
+            # Tasks spawned by a job, like gathered fetches, inherit its context but are not registered themselves
+            job = _jobs.get(task) or task.get_context().get(_current_job)
+        except Exception:
+            job = None
+
+        logging.warning(
+            f'Event loop blocked for {blocked:.2f}s'
+            f' (url: {job.url if job else "-"}, platform: {job.platform if job else "-"}):\n{stack}'
+        )
+
+
+@contextlib.asynccontextmanager
+async def job(url: str) -> typing.AsyncIterator[typing.Optional[JobInfo]]:
+    """
+    Tags the current task with the job's url for blocking reports and dumps stage timings and a profile
+    of the loop for jobs slower than SLOW_JOB_SECONDS. Only one job is profiled at a time and its profile
+    covers everything that ran on the loop while it was in flight.
+    """
+    global _profiled_job
+
+    if not DIAGNOSTICS:
+        yield None
+        return
+
+    info = JobInfo(url=url)
+    token = _current_job.set(info)
+    _jobs[asyncio.current_task()] = info
+
+    profiler = None
+    if not _profiled_job:
+        _profiled_job = info
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        yield info
+    finally:
+        if profiler:
+            profiler.disable()
+            _profiled_job = None
+
+        duration = time.monotonic() - info.started
+        metrics.observe('job.duration', duration)
+        if duration > SLOW_JOB_SECONDS:
+            _dump_slow_job(info=info, duration=duration, profiler=profiler)
+
+        _current_job.reset(token)
+
+
+def current_job() -> typing.Optional[JobInfo]:
+    return _current_job.get()
+
+
+@contextlib.contextmanager
+def stage(name: str) -> typing.Iterator[None]:
+    info = _current_job.get()
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if info:
+            info.stages[name] += time.monotonic() - start
+
+
+def start() -> typing.Optional[asyncio.Task]:
+    if not DIAGNOSTICS:
+        return None
+
+    logging.info('Diagnostics enabled')
+    return asyncio.create_task(LoopMonitor().run())
+
+
+def _dump_slow_job(info: JobInfo, duration: float, profiler: typing.Optional[cProfile.Profile]) -> None:
+    metrics.increment('job.slow')
+
+    stages = ', '.join(f'{name}: {seconds:.2f}s' for name, seconds in info.stages.items())
+    profile = ''
+    if profiler:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(25)
+        profile = f'\n{stream.getvalue()}'
+
+    logging.warning(f'Slow job {info.url} ({info.platform}) took {duration:.2f}s [{stages}]{profile}')
@@ -1,27 +1,117 @@
-import io
+import asyncio
+import logging
+import os
 import typing
+from urllib.parse import urlparse
 
 import aiohttp
 
+import constants
+import memory
 import models
 
 
+CHUNK_SIZE = 64 * 1024
+MEDIA_CONCURRENCY = int(os.getenv('MEDIA_CONCURRENCY') or 4)
+EMBED_ALL_MEDIA = (os.getenv('EMBED_ALL_MEDIA') or 'true').lower() == 'true'
+
+
+class SessionSingleton(object):
+    INSTANCE: typing.Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def get_instance(cls) -> aiohttp.ClientSession:
+        if not cls.INSTANCE or cls.INSTANCE.closed:
+            cls.INSTANCE = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+
+        return cls.INSTANCE
+
+
 class BaseClient(object):
     DOMAINS: typing.List[str]
     MESSAGE = '🔗 URL: {url}\n📕 Description: {description}\n👍 Likes: {likes}\n'
 
     def __init__(self, url: str):
         self.url = url
+        self.all_media = EMBED_ALL_MEDIA
+        self.tier = constants.DegradationTier.FULL
+        self.on_metadata: typing.Optional[typing.Callable[[models.Post], typing.Awaitable[None]]] = None
+        self._metadata_published = False
+
+    @property
+    def canonical_id(self) -> typing.Optional[str]:
+        parsed_url = urlparse(self.url)
+        return f'{parsed_url.netloc.removeprefix("www.")}{parsed_url.path.rstrip("/")}'
+
+    @property
+    def metadata_only(self) -> bool:
+        return self.tier >= constants.DegradationTier.METADATA_ONLY
+
+    @property
+    def low_bitrate(self) -> bool:
+        return self.tier >= constants.DegradationTier.LOW_BITRATE
+
+    @classmethod
+    async def warm_up(cls) -> typing.Optional[bool]:
+        """
+        Initializes and health checks shared platform clients. Returns False if the platform is not configured
+        and None if it has nothing to check.
+        """
+        return None
 
     async def get_post(self) -> models.Post:
         raise NotImplementedError()
 
-    async def _download(self, url: str, cookies: typing.Optional[typing.Dict[str, str]] = None, **kwargs) -> io.BytesIO:
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            async with session.get(url=url, **kwargs) as resp:
-                return io.BytesIO(await resp.read())
+    async def _publish_metadata(self, post: models.Post) -> None:
+        """
+        Hands the scraped post to the front-end before any media is downloaded so it can reply early.
+        """
+        if not self.on_metadata or self._metadata_published:
+            return
+
+        self._metadata_published = True
+        try:
+            await self.on_metadata(post)
+        except Exception as e:
+            logging.error(f'Failed publishing metadata for {self.url}: {str(e)}')
+
+    async def _download(
+        self,
+        url: str,
+        cookies: typing.Optional[typing.Dict[str, str]] = None,
+        **kwargs,
+    ) -> typing.Optional[typing.BinaryIO]:
+        if self.metadata_only:
+            return None
+
+        async with SessionSingleton.get_instance().get(url=url, cookies=cookies, **kwargs) as resp:
+            buffer = memory.accountant.allocate(size_hint=resp.content_length or 0)
+            try:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    buffer.write(chunk)
+            except Exception:
+                buffer.close()
+                raise
+            buffer.seek(0)
+            return buffer
+
+    async def _download_all(
+        self,
+        urls: typing.List[str],
+        cookies: typing.Optional[typing.Dict[str, str]] = None,
+        **kwargs,
+    ) -> typing.List[typing.BinaryIO]:
+        if self.metadata_only:
+            return []
+
+        semaphore = asyncio.Semaphore(MEDIA_CONCURRENCY)
+
+        async def download(url: str) -> typing.BinaryIO:
+            async with semaphore:
+                return await self._download(url=url, cookies=cookies, **kwargs)
+
+        return list(await asyncio.gather(*(download(url) for url in urls)))
 
     async def _fetch_content(self, url: str, cookies: typing.Optional[typing.Dict[str, str]] = None, **kwargs) -> str:
-        async with aiohttp.ClientSession(cookies=cookies) as session:
-            async with session.get(url=url, **kwargs) as resp:
-                return await resp.text()
+        async with SessionSingleton.get_instance().get(url=url, cookies=cookies, **kwargs) as resp:
+            return await resp.text()
@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import os
+import time
+import typing
+
+import constants
+import diagnostics
+import memory
+import metrics
+import models
+import utils
+from downloader import base
+
+
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS') or 8)
+DEGRADATION = (os.getenv('DEGRADATION') or 'true').lower() == 'true'
+QUEUE_HIGH_WATERMARK = int(os.getenv('QUEUE_HIGH_WATERMARK') or MAX_CONCURRENT_JOBS * 2)
+FFMPEG_HIGH_WATERMARK = int(os.getenv('FFMPEG_HIGH_WATERMARK') or os.cpu_count() or 1)
+TIER_RECOVERY_SECONDS = float(os.getenv('TIER_RECOVERY_SECONDS') or 30)
+TIER_EVALUATION_INTERVAL = 5
+# Lowest pressure (max of queue, ffmpeg backlog and memory usage relative to their limits) at which each tier applies
+TIER_PRESSURE = {
+    constants.DegradationTier.LOW_BITRATE: 0.5,
+    constants.DegradationTier.NO_REENCODE: 0.75,
+    constants.DegradationTier.IMAGE_ALBUM: 1.0,
+    constants.DegradationTier.METADATA_ONLY: 1.5,
+}
+
+
+class LoadShedder(object):
+    """
+    Picks the degradation tier for new jobs from the current load. Degrades immediately under pressure and
+    recovers one tier at a time once the load has stayed low for TIER_RECOVERY_SECONDS.
+    """
+
+    def __init__(self) -> None:
+        self.tier = constants.DegradationTier.FULL
+        self._low_since = time.monotonic()
+
+    def pressure(self) -> float:
+        return max(
+            queued / QUEUE_HIGH_WATERMARK,
+            utils.ffmpeg_backlog / FFMPEG_HIGH_WATERMARK,
+            memory.accountant.in_use / memory.accountant.budget,
+        )
+
+    def current_tier(self) -> constants.DegradationTier:
+        if not DEGRADATION:
+            return constants.DegradationTier.FULL
+
+        pressure = self.pressure()
+        target = constants.DegradationTier.FULL
+        for tier, threshold in TIER_PRESSURE.items():
+            if pressure >= threshold:
+                target = tier
+
+        now = time.monotonic()
+        if target > self.tier:
+            self._set_tier(tier=target, pressure=pressure)
+            self._low_since = now
+        elif target == self.tier:
+            self._low_since = now
+        elif now - self._low_since >= TIER_RECOVERY_SECONDS:
+            self._set_tier(tier=constants.DegradationTier(self.tier - 1), pressure=pressure)
+            self._low_since = now
+
+        return self.tier
+
+    async def run(self, interval: float = TIER_EVALUATION_INTERVAL) -> typing.NoReturn:
+        """
+        Keeps recovering the tier while no new jobs are admitted.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            self.current_tier()
+
+    def _set_tier(self, tier: constants.DegradationTier, pressure: float) -> None:
+        logging.warning(f'Load pressure {pressure:.2f}, switching from {self.tier.name} to {tier.name}')
+        metrics.increment(f'engine.tier.{tier.name.lower()}')
+        metrics.gauge('engine.tier', int(tier))
+        self.tier = tier
+
+
+_slots = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+_metadata_slots = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+queued = 0
+active = 0
+
+
+async def get_post(client: base.BaseClient) -> models.Post:
+    """
+    Fetches a post once a job slot and media memory are available. Shared by every bot front-end.
+    Metadata only jobs download no media and bypass both.
+    """
+    global queued, active
+
+    info = diagnostics.current_job()
+    if info:
+        platforms = info.platform.split(', ') if info.platform else []
+        if type(client).__name__ not in platforms:
+            info.platform = ', '.join(platforms + [type(client).__name__])
+
+    client.tier = shedder.current_tier()
+    if client.metadata_only:
+        return await _get_metadata(client=client)
+
+    queued += 1
+    metrics.gauge('engine.queued', queued)
+    try:
+        with diagnostics.stage('queue'):
+            await _slots.acquire()
+    finally:
+        queued -= 1
+        metrics.gauge('engine.queued', queued)
+
+    active += 1
+    metrics.gauge('engine.active', active)
+    try:
+        with diagnostics.stage('memory_wait'):
+            await memory.accountant.wait_for_capacity()
+        with diagnostics.stage('get_post'):
+            return await client.get_post()
+    finally:
+        active -= 1
+        metrics.gauge('engine.active', active)
+        _slots.release()
+
+
+async def _get_metadata(client: base.BaseClient) -> models.Post:
+    metrics.increment('engine.metadata_only')
+    async with _metadata_slots:
+        with diagnostics.stage('get_post'):
+            post = await client.get_post()
+    post.compact_post = True
+    return post
+
+
+shedder = LoadShedder()
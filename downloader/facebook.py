@@ -1,4 +1,6 @@
 import os
+import typing
+from urllib.parse import parse_qs, urlparse
 
 import facebook_scraper
 
@@ -6,9 +8,25 @@ import models
 from downloader import base
 
 
+# Query parameters holding the post id on shared paths like /watch/, /story.php and /photo.php
+POST_ID_PARAMS = ['v', 'story_fbid', 'fbid']
+
+
 class FacebookClient(base.BaseClient):
     DOMAINS = ['facebook.com', 'fb.watch']
 
+    @property
+    def canonical_id(self) -> typing.Optional[str]:
+        parsed_url = urlparse(self.url)
+        query = parse_qs(parsed_url.query)
+        for param in POST_ID_PARAMS:
+            if param in query:
+                return f'facebook:{param}:{query[param][0]}'
+
+        if parsed_url.path.rstrip('/').endswith(('/watch', '.php')):
+            return None
+        return super().canonical_id
+
     async def get_post(self) -> models.Post:
         kwargs = {}
         if os.path.exists('cookies.txt'):
@@ -24,10 +42,12 @@ class FacebookClient(base.BaseClient):
             likes=fb_post.get('likes'),
             created=ts.astimezone() if ts else None,
         )
+        await self._publish_metadata(post)
 
         if fb_post.get('video'):
             post.buffer = await self._download(url=fb_post['video'])
         elif fb_post.get('images'):
-            post.buffer = await self._download(url=fb_post['images'][0])
+            images = fb_post['images'] if self.all_media else fb_post['images'][:1]
+            post.buffers = await self._download_all(urls=images)
 
         return post
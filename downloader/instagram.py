@@ -1,16 +1,25 @@
+import asyncio
+import collections
+import dataclasses
+import datetime
 import enum
-import io
 import os
+import threading
+import time
 import typing
 from urllib.parse import parse_qs, urlparse
 
 import instaloader
-import requests
 
+import metrics
 import models
 from downloader import base
 
 
+INSTAGRAM_CACHE_TTL = int(os.getenv('INSTAGRAM_CACHE_TTL') or 60 * 60)
+INSTAGRAM_CACHE_SIZE = 1000
+
+
 class LinkType(enum.Enum):
     MEDIA = 1
     PROFILE = 2
@@ -25,21 +34,65 @@ class LinkType(enum.Enum):
         return cls.PROFILE
 
 
+@dataclasses.dataclass
+class PostMetadata:
+    author: str
+    description: typing.Optional[str]
+    likes: typing.Optional[int]
+    views: typing.Optional[int]
+    created: datetime.datetime
+    media_urls: typing.List[str]
+
+
+class MetadataCache(object):
+    """
+    Keeps scraped post metadata by shortcode so reposts and other indexes of a sidecar skip the GraphQL request.
+    """
+
+    def __init__(self, ttl: int = INSTAGRAM_CACHE_TTL, max_size: int = INSTAGRAM_CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache: typing.OrderedDict[str, typing.Tuple[float, PostMetadata]] = collections.OrderedDict()
+
+    def get(self, shortcode: str) -> typing.Optional[PostMetadata]:
+        entry = self._cache.get(shortcode)
+        if not entry:
+            return None
+
+        expires, metadata = entry
+        if expires < time.monotonic():
+            del self._cache[shortcode]
+            return None
+
+        self._cache.move_to_end(shortcode)
+        return metadata
+
+    def put(self, shortcode: str, metadata: PostMetadata) -> None:
+        self._cache[shortcode] = (time.monotonic() + self.ttl, metadata)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+
 class InstagramClientSingleton(object):
     INSTANCE: typing.Optional[instaloader.Instaloader] = None
+    LOCK = threading.Lock()
 
     @classmethod
     def get_instance(cls) -> typing.Optional[instaloader.Instaloader]:
-        if cls.INSTANCE:
-            return cls.INSTANCE
-
-        cls.INSTANCE = instaloader.Instaloader(
-            user_agent='Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/116.0'
-        )
-        if os.path.exists('instagram.sess') and os.getenv('INSTAGRAM_USERNAME') is not None:
-            cls.INSTANCE.load_session_from_file(username=os.getenv('INSTAGRAM_USERNAME'), filename='instagram.sess')
+        with cls.LOCK:
+            if cls.INSTANCE:
+                return cls.INSTANCE
+
+            # The iPhone API variants of media urls cost an extra request per post on top of the GraphQL one
+            instance = instaloader.Instaloader(
+                user_agent='Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/116.0',
+                iphone_support=False,
+            )
+            if os.path.exists('instagram.sess') and os.getenv('INSTAGRAM_USERNAME') is not None:
+                instance.load_session_from_file(username=os.getenv('INSTAGRAM_USERNAME'), filename='instagram.sess')
 
-        return cls.INSTANCE
+            cls.INSTANCE = instance
+            return cls.INSTANCE
 
 
 class InstagramClient(base.BaseClient):
@@ -51,70 +104,138 @@ class InstagramClient(base.BaseClient):
 
         parsed_url = urlparse(url)
         self.id = parsed_url.path.strip('/').split('/')[-1]
-        self.index = int(parse_qs(parsed_url.query).get('img_index', ['1'])[0]) - 1
+        img_index = parse_qs(parsed_url.query).get('img_index')
+        self.index = int(img_index[0]) - 1 if img_index else 0
+        self.all_media = self.all_media and not img_index
         self._link_type = LinkType.from_url(url=url)
 
+    @property
+    def canonical_id(self) -> typing.Optional[str]:
+        if self._link_type == LinkType.PROFILE:
+            return None
+        return f'instagram:{self.id}:{"all" if self.all_media else self.index}'
+
+    @classmethod
+    async def warm_up(cls) -> bool:
+        client = await asyncio.to_thread(InstagramClientSingleton.get_instance)
+        if client.context.is_logged_in and not await asyncio.to_thread(client.test_login):
+            raise Exception('Instagram session is no longer valid')
+
+        return True
+
     async def get_post(self) -> models.Post:
         match self._link_type:
             case LinkType.STORY:
-                return self._get_story()
+                return await self._get_story()
             case LinkType.MEDIA:
-                return self._get_post()
+                return await self._get_post()
             case LinkType.PROFILE:
-                return self._get_profile()
+                return await self._get_profile()
 
         raise NotImplementedError(f'Not yet implemented for {self.url}')
 
-    def _get_post(self) -> models.Post:
+    async def _get_post(self) -> models.Post:
+        metadata = metadata_cache.get(self.id)
+        if metadata:
+            metrics.increment('instagram.metadata_cache.hits')
+        else:
+            metrics.increment('instagram.metadata_cache.misses')
+            metadata = await asyncio.to_thread(self._fetch_metadata)
+            metadata_cache.put(self.id, metadata)
+
+        post = models.Post(
+            url=self.url,
+            author=metadata.author,
+            description=metadata.description,
+            likes=metadata.likes,
+            views=metadata.views,
+            created=metadata.created,
+        )
+        await self._publish_metadata(post)
+        download_urls = metadata.media_urls if self.all_media else [metadata.media_urls[self.index]]
+        post.buffers = await self._download_all(urls=download_urls, **self._session_state())
+        return post
+
+    def _fetch_metadata(self) -> PostMetadata:
+        """
+        Runs in a worker thread. Everything below is read from the single GraphQL response of from_shortcode.
+        """
         p = instaloader.Post.from_shortcode(context=self.client.context, shortcode=self.id)
 
         match p.typename:
             case 'GraphImage':
-                download_url = p.url
+                media_urls = [p.url]
             case 'GraphVideo':
-                download_url = p.video_url
+                media_urls = [p.video_url]
             case 'GraphSidecar':
-                node = next(p.get_sidecar_nodes(start=self.index, end=self.index))
-                if node.is_video:
-                    download_url = node.video_url
-                else:
-                    download_url = node.display_url
-
-        with requests.get(url=download_url) as resp:
-            return models.Post(
-                url=self.url,
-                author=p.owner_profile.username,
-                description=p.title or p.caption,
-                likes=p.likes,
-                views=p.video_view_count,
-                buffer=io.BytesIO(resp.content),
-                created=p.date_local,
-            )
+                media_urls = [node.video_url if node.is_video else node.display_url for node in p.get_sidecar_nodes()]
+
+        return PostMetadata(
+            author=p.owner_username,
+            description=p.title or p.caption,
+            likes=p.likes,
+            views=p.video_view_count,
+            created=p.date_local,
+            media_urls=media_urls,
+        )
 
-    def _get_story(self) -> models.Post:
+    async def _get_story(self) -> models.Post:
+        metadata = await asyncio.to_thread(self._fetch_story_metadata)
+
+        post = models.Post(
+            url=self.url,
+            author=metadata.author,
+            description=metadata.description,
+            created=metadata.created,
+        )
+        await self._publish_metadata(post)
+        post.buffer = await self._download(url=metadata.media_urls[0], **self._session_state())
+        return post
+
+    def _fetch_story_metadata(self) -> PostMetadata:
+        """
+        Runs in a worker thread. The owner is read from the story node, StoryItem.owner_username fetches the profile.
+        """
         story = instaloader.StoryItem.from_mediaid(context=self.client.context, mediaid=int(self.id))
         if story.is_video:
             url = story.video_url or story.url
         else:
             url = story.url or story.video_url
 
-        with requests.get(url=url) as resp:
-            return models.Post(
-                url=self.url,
-                author=story.owner_profile.username,
-                description=story.caption,
-                buffer=io.BytesIO(resp.content),
-                created=story.date_local,
-            )
+        return PostMetadata(
+            author=story._node['owner'].get('username'),
+            description=story.caption,
+            likes=None,
+            views=None,
+            created=story.date_local,
+            media_urls=[url],
+        )
 
-    def _get_profile(self) -> models.Post:
-        profile = instaloader.Profile.from_username(context=self.client.context, username=self.id)
+    async def _get_profile(self) -> models.Post:
+        profile = await asyncio.to_thread(
+            instaloader.Profile.from_username,
+            context=self.client.context,
+            username=self.id,
+        )
 
-        with requests.get(url=profile.profile_pic_url) as resp:
-            return models.Post(
-                url=self.url,
-                author=profile.username,
-                description=profile.biography,
-                buffer=io.BytesIO(resp.content),
-                likes=profile.followers,
-            )
+        post = models.Post(
+            url=self.url,
+            author=profile.username,
+            description=profile.biography,
+            likes=profile.followers,
+        )
+        await self._publish_metadata(post)
+        post.buffer = await self._download(url=profile.profile_pic_url, **self._session_state())
+        return post
+
+    def _session_state(self) -> typing.Dict[str, typing.Any]:
+        """
+        Media is downloaded with the shared aiohttp session but as the logged in Instaloader session.
+        """
+        return {
+            'cookies': self.client.context._session.cookies.get_dict(),
+            'headers': {'User-Agent': self.client.context.user_agent},
+        }
+
+
+metadata_cache = MetadataCache()
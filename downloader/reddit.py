@@ -1,5 +1,5 @@
 import datetime
-import io
+import html
 import os
 import typing
 
@@ -8,8 +8,10 @@ import redvid
 import requests
 from asyncpraw import exceptions as praw_exceptions
 
+import memory
 import models
 from downloader import base
+from downloader import resolver
 
 
 class RedditClientSingleton(object):
@@ -40,6 +42,15 @@ class RedditClient(base.BaseClient):
         super(RedditClient, self).__init__(url=url)
         self.client = RedditClientSingleton.get_instance()
 
+    @classmethod
+    async def warm_up(cls) -> bool:
+        client = RedditClientSingleton.get_instance()
+        if not client:
+            return False
+
+        await client.subreddit('all', fetch=True)
+        return True
+
     async def get_post(self) -> models.Post:
         post = models.Post(url=self.url)
 
@@ -56,7 +67,8 @@ class RedditClient(base.BaseClient):
         try:
             submission = await self.client.submission(url=self.url)
         except praw_exceptions.InvalidURL:
-            self.url = requests.get(self.url).url.split('?')[0]
+            canonical_url = await resolver.resolver.resolve(url=self.url, is_canonical=lambda u: '/comments/' in u)
+            self.url = canonical_url.split('?')[0]
             submission = await self.client.submission(url=self.url)
 
         content = ''
@@ -69,19 +81,34 @@ class RedditClient(base.BaseClient):
         post.likes = submission.score
         post.spoiler = submission.over_18 or submission.spoiler
         post.created = datetime.datetime.fromtimestamp(submission.created_utc).astimezone()
+        await self._publish_metadata(post)
 
-        if submission.url.startswith('https://i.redd.it/'):
+        if getattr(submission, 'is_gallery', False):
+            urls = self._gallery_urls(submission=submission)
+            post.buffers = await self._download_all(urls=urls if self.all_media else urls[:1])
+        elif submission.url.startswith('https://i.redd.it/'):
             post.buffer = await self._download(url=submission.url)
-        elif submission.url.startswith('https://v.redd.it/'):
+        elif submission.url.startswith('https://v.redd.it/') and not self.metadata_only:
             redvid.Downloader(
-                url=submission.url, path='/tmp', filename=f'{submission.id}.mp4', max_q=True, log=False
+                url=submission.url,
+                path='/tmp',
+                filename=f'{submission.id}.mp4',
+                max_q=not self.low_bitrate,
+                min_q=self.low_bitrate,
+                log=False,
             ).download()
-            with open(f'/tmp/{submission.id}.mp4', 'rb') as f:
-                post.buffer = io.BytesIO(f.read())
+            post.buffer = memory.accountant.from_file(f'/tmp/{submission.id}.mp4')
             os.remove(f'/tmp/{submission.id}.mp4')
 
         return True
 
+    def _gallery_urls(self, submission: asyncpraw.models.Submission) -> typing.List[str]:
+        urls = []
+        for item in submission.gallery_data['items']:
+            source = submission.media_metadata[item['media_id']]['s']
+            urls.append(html.unescape(source.get('u') or source.get('gif')))
+        return urls
+
     def _is_nsfw(self) -> bool:
         content = str(requests.get(self.url).content)
         return 'nsfw&quot;:true' in content or 'isNsfw&quot;:true' in content
@@ -1,3 +1,9 @@
+import asyncio
+import logging
+import typing
+
+import metrics
+import utils
 from downloader import base
 from downloader import facebook
 from downloader import instagram
@@ -16,6 +22,17 @@ CLASSES = {
     youtube.YoutubeClient,
 }
 
+READINESS: typing.Dict[str, str] = {}
+_warm_up_task: typing.Optional[asyncio.Task] = None
+
+
+def is_supported(url: str) -> bool:
+    return any(domain in url for klass in CLASSES for domain in klass.DOMAINS)
+
+
+def find_supported_urls(string: str) -> typing.List[str]:
+    return [url for url in utils.find_all_urls(string) if is_supported(url)]
+
 
 def get_instance(url: str) -> base.BaseClient:
     for klass in CLASSES:
@@ -23,3 +40,32 @@ def get_instance(url: str) -> base.BaseClient:
             return klass(url)
 
     raise ValueError(f'Unsupported url {url}')
+
+
+def start_warm_up() -> asyncio.Task:
+    global _warm_up_task
+
+    if not _warm_up_task:
+        _warm_up_task = asyncio.create_task(warm_up())
+    return _warm_up_task
+
+
+async def warm_up() -> typing.Dict[str, str]:
+    await asyncio.gather(*(_warm_up(klass=klass) for klass in CLASSES))
+    return READINESS
+
+
+async def _warm_up(klass: typing.Type[base.BaseClient]) -> None:
+    name = klass.__name__.removesuffix('Client').lower()
+    READINESS[name] = 'starting'
+
+    try:
+        ready = await klass.warm_up()
+        READINESS[name] = 'unchecked' if ready is None else 'ready' if ready else 'not configured'
+    except Exception as e:
+        logging.error(f'Failed warming up {name}: {str(e)}')
+        READINESS[name] = 'failed'
+
+    if READINESS[name] != 'unchecked':
+        metrics.gauge(f'platform.ready.{name}', int(READINESS[name] == 'ready'))
+    logging.info(f'Platform {name} is {READINESS[name]}')
@@ -0,0 +1,89 @@
+import collections
+import os
+import time
+import typing
+from urllib.parse import urljoin
+
+import metrics
+from downloader import base
+
+
+SHORT_LINK_CACHE_TTL = int(os.getenv('SHORT_LINK_CACHE_TTL') or 24 * 60 * 60)
+SHORT_LINK_CACHE_SIZE = 10000
+MAX_REDIRECTS = 10
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+headers = {
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) '
+    'AppleWebKit/537.36 (KHTML, like Gecko) '
+    'Chrome/39.0.2171.95 Safari/537.36'
+}
+
+
+class ShortLinkResolver(object):
+    """
+    Follows share link redirects one hop at a time without downloading page bodies and caches the results.
+    """
+
+    def __init__(self, ttl: int = SHORT_LINK_CACHE_TTL, max_size: int = SHORT_LINK_CACHE_SIZE) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self._cache: typing.OrderedDict[str, typing.Tuple[float, str]] = collections.OrderedDict()
+
+    def cached(self, url: str) -> typing.Optional[str]:
+        entry = self._cache.get(url)
+        if not entry:
+            return None
+
+        expires, canonical_url = entry
+        if expires < time.monotonic():
+            del self._cache[url]
+            return None
+
+        self._cache.move_to_end(url)
+        return canonical_url
+
+    async def resolve(self, url: str, is_canonical: typing.Callable[[str], bool]) -> str:
+        canonical_url = self.cached(url)
+        if canonical_url:
+            metrics.increment('resolver.cache.hits')
+            return canonical_url
+
+        metrics.increment('resolver.cache.misses')
+        canonical_url = url
+        for _ in range(MAX_REDIRECTS):
+            location = await self._next_location(url=canonical_url)
+            if not location:
+                break
+
+            canonical_url = urljoin(canonical_url, location)
+            if is_canonical(canonical_url):
+                break
+
+        if not is_canonical(canonical_url):
+            # Blocked or cut short, retry on the next request instead of pinning the share link
+            metrics.increment('resolver.unresolved')
+            return canonical_url
+
+        self._cache[url] = (time.monotonic() + self.ttl, canonical_url)
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+        return canonical_url
+
+    async def _next_location(self, url: str) -> typing.Optional[str]:
+        session = base.SessionSingleton.get_instance()
+
+        async with session.head(url=url, headers=headers, allow_redirects=False) as resp:
+            if resp.status in REDIRECT_STATUSES:
+                return resp.headers.get('Location')
+            if resp.status < 400:
+                return None
+
+        # Some hosts reject HEAD requests, the body of the GET response is never read
+        async with session.get(url=url, headers=headers, allow_redirects=False) as resp:
+            if resp.status in REDIRECT_STATUSES:
+                return resp.headers.get('Location')
+            return None
+
+
+resolver = ShortLinkResolver()
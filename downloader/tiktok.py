@@ -1,88 +1,206 @@
 import asyncio
-import glob
-import io
+import contextlib
+import hashlib
 import logging
 import os
+import re
+import tempfile
+import time
 import typing
-import urllib
+from urllib.parse import urlparse
 
-import ffmpeg
-import requests
 from tiktokapipy.async_api import AsyncTikTokAPI
 from tiktokapipy.models import user
 from tiktokapipy.models import video
 
+import constants
+import memory
+import metrics
 import models
+import utils
 from downloader import base
+from downloader import resolver
 
 
 headers = {'referer': 'https://www.tiktok.com/'}
+video_id_pattern = re.compile(r'/(?:video|photo)/(\d+)')
+
+TIKTOK_CACHE_DIR = os.getenv('TIKTOK_CACHE_DIR') or os.path.join(tempfile.gettempdir(), 'tiktok')
+TIKTOK_CACHE_TTL = int(os.getenv('TIKTOK_CACHE_TTL') or 24 * 60 * 60)
+AUDIO_CACHE_DIR = os.path.join(TIKTOK_CACHE_DIR, 'audio')
+RENDER_CACHE_DIR = os.path.join(TIKTOK_CACHE_DIR, 'renders')
+
+
+class KeyedLocks(object):
+    """
+    Per-key asyncio locks, dropped as soon as nobody holds or waits for them.
+    """
+
+    def __init__(self) -> None:
+        self._locks: typing.Dict[str, typing.Tuple[asyncio.Lock, int]] = {}
+
+    @contextlib.asynccontextmanager
+    async def __call__(self, key: str) -> typing.AsyncIterator[None]:
+        lock, users = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = (lock, users - 1)
+
+
+class AudioTrackCache(object):
+    """
+    Keeps slideshow sounds downloaded and normalized to AAC, keyed by music id, together with their durations.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.durations: typing.Dict[str, float] = {}
+        self._locks = KeyedLocks()
+
+    async def get(self, music: video.MusicData, cookies: typing.Dict[str, str]) -> typing.Tuple[str, float]:
+        music_id = str(music.id)
+        path = os.path.join(self.directory, f'{music_id}.m4a')
+
+        async with self._locks(music_id):
+            if _touch(path=path):
+                metrics.increment('tiktok.audio_cache.hits')
+                if music_id not in self.durations:
+                    self.durations[music_id] = await utils.probe_duration(path=path)
+                return path, self.durations[music_id]
+
+            metrics.increment('tiktok.audio_cache.misses')
+            for name in _evict_expired(directory=self.directory):
+                self.durations.pop(name.removesuffix('.m4a'), None)
+            with tempfile.TemporaryDirectory(dir=TIKTOK_CACHE_DIR) as directory:
+                source_path = os.path.join(directory, 'source.mp3')
+                normalized_path = os.path.join(directory, 'normalized.m4a')
+                await _download_to_file(url=music.play_url, path=source_path, cookies=cookies)
+                await utils.run_ffmpeg(
+                    command=['ffmpeg', '-y', f'-i {source_path}', '-vn', '-acodec aac', '-b:a 128k', normalized_path]
+                )
+                if not os.path.exists(normalized_path):
+                    raise Exception(f'Failed normalizing tiktok sound {music_id}')
+                os.replace(normalized_path, path)
+
+            self.durations[music_id] = await utils.probe_duration(path=path)
+            return path, self.durations[music_id]
 
 
 class TiktokClient(base.BaseClient):
     DOMAINS = ['tiktok.com']
 
+    @property
+    def canonical_id(self) -> typing.Optional[str]:
+        match = video_id_pattern.search(resolver.resolver.cached(self.url) or self.url)
+        if not match:
+            return super().canonical_id
+        return f'tiktok:{match.group(1)}'
+
     async def get_post(self) -> models.Post:
-        clean_url = self._clean_url(self.url)
+        clean_url = await self._clean_url(self.url)
 
         logging.debug(f'Trying to download tiktok video {clean_url}...')
 
         async with AsyncTikTokAPI() as api:
             video = await api.video(clean_url)
             cookies = {cookie['name']: cookie['value'] for cookie in await api.context.cookies()}
+            post = models.Post(
+                url=self.url,
+                author=video.author.unique_id if isinstance(video.author, user.LightUser) else video.author,
+                description=video.desc,
+                views=video.stats.play_count,
+                likes=video.stats.digg_count,
+                created=video.create_time.astimezone(),
+            )
+            await self._publish_metadata(post)
             if video.image_post:
-                buffer = await self._download_slideshow(
+                post.buffers = await self._download_slideshow(
                     video=video,
                     cookies=cookies,
                 )
             else:
-                buffer = await self._download(
+                post.buffer = await self._download(
                     url=video.video.download_addr,
                     cookies=cookies,
                     headers=headers,
                 )
-            return models.Post(
-                url=self.url,
-                author=video.author.unique_id if isinstance(video.author, user.LightUser) else video.author,
-                description=video.desc,
-                views=video.stats.play_count,
-                likes=video.stats.digg_count,
-                buffer=buffer,
-                created=video.create_time.astimezone(),
-            )
+            return post
+
+    async def _download_slideshow(
+        self,
+        video: video.Video,
+        cookies: typing.Dict[str, str],
+    ) -> typing.List[typing.BinaryIO]:
+        if self.metadata_only:
+            return []
+
+        image_urls = [image_data.image_url.url_list[-1] for image_data in video.image_post.images]
+        image_set_hash = hashlib.sha1(''.join(urlparse(url).path for url in image_urls).encode()).hexdigest()
+        render_path = os.path.join(RENDER_CACHE_DIR, f'{video.id}_{image_set_hash}.mp4')
+
+        async with _render_locks(render_path):
+            if _touch(path=render_path):
+                metrics.increment('tiktok.render_cache.hits')
+                return [memory.accountant.from_file(render_path)]
+
+            if self.tier >= constants.DegradationTier.IMAGE_ALBUM:
+                return await self._download_all(urls=image_urls, cookies=cookies, headers=headers)
 
-    async def _download_slideshow(self, video: video.Video, cookies: typing.Dict[str, str]) -> io.BytesIO:
+            metrics.increment('tiktok.render_cache.misses')
+            _evict_expired(directory=RENDER_CACHE_DIR)
+            audio_path, audio_duration = await audio_tracks.get(music=video.music, cookies=cookies)
+            with tempfile.TemporaryDirectory(dir=TIKTOK_CACHE_DIR) as directory:
+                await self._render_slideshow(
+                    directory=directory,
+                    image_urls=image_urls,
+                    audio_path=audio_path,
+                    audio_duration=audio_duration,
+                    cookies=cookies,
+                )
+                os.replace(os.path.join(directory, 'slideshow.mp4'), render_path)
+
+            return [memory.accountant.from_file(render_path)]
+
+    async def _render_slideshow(
+        self,
+        directory: str,
+        image_urls: typing.List[str],
+        audio_path: str,
+        audio_duration: float,
+        cookies: typing.Dict[str, str],
+    ) -> None:
         vf = (
             '"scale=iw*min(1080/iw\\,1920/ih):ih*min(1080/iw\\,1920/ih),'
             'pad=1080:1920:(1080-iw)/2:(1920-ih)/2,'
             'format=yuv420p"'
         )
-        directory = '/tmp'
-
-        for i, image_data in enumerate(video.image_post.images):
-            url = image_data.image_url.url_list[-1]
-            urllib.request.urlretrieve(url, os.path.join(directory, f'temp_{video.id}_{i:02}.jpg'))
-
-        read = requests.get(video.music.play_url, cookies=cookies, headers=headers)
-        with open(os.path.join(directory, f'temp_{video.id}.mp3'), 'wb') as w:
-            for chunk in read.iter_content(chunk_size=512):
-                if chunk:
-                    w.write(chunk)
 
-        audio_duration = float(ffmpeg.probe(f'{directory}/temp_{video.id}.mp3')['format']['duration'])
+        await asyncio.gather(
+            *(
+                _download_to_file(url=url, path=os.path.join(directory, f'image_{i:02}.jpg'), cookies=cookies)
+                for i, url in enumerate(image_urls)
+            )
+        )
 
-        if audio_duration <= (len(video.image_post.images) * 2.5):
+        if audio_duration <= (len(image_urls) * 2.5):
             command = [
                 'ffmpeg',
                 '-y',
                 '-r 2/5',
-                f'-i {directory}/temp_{video.id}_%02d.jpg',
-                f'-i {directory}/temp_{video.id}.mp3',
+                f'-i {directory}/image_%02d.jpg',
+                f'-i {audio_path}',
                 '-r 30',
                 f'-vf {vf}',
                 '-acodec copy',
-                f'-t {len(video.image_post.images) * 2.5}',
-                f'{directory}/temp_{video.id}.mp4',
+                f'-t {len(image_urls) * 2.5}',
+                f'{directory}/slideshow.mp4',
             ]
         else:
             command = [
@@ -90,47 +208,59 @@ class TiktokClient(base.BaseClient):
                 '-y',
                 '-loop 1',
                 '-framerate 1/2.5',
-                f'-i {directory}/temp_{video.id}_%02d.jpg',
-                f'-i {directory}/temp_{video.id}.mp3',
+                f'-i {directory}/image_%02d.jpg',
+                f'-i {audio_path}',
                 '-shortest',
-                '-acodec aac',
+                '-acodec copy',
                 '-vcodec libx264',
                 '-movflags +faststart',
                 f'-vf {vf}',
-                f'{directory}/temp_{video.id}.mp4',
+                f'{directory}/slideshow.mp4',
             ]
 
-        ffmpeg_proc = await asyncio.create_subprocess_shell(
-            ' '.join(command),
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        await ffmpeg_proc.communicate()
-        generated_files = glob.glob(os.path.join(directory, f'temp_{video.id}*'))
+        await utils.run_ffmpeg(command=command)
 
-        if not os.path.exists(os.path.join(directory, f'temp_{video.id}.mp4')):
-            for file in generated_files:
-                os.remove(file)
+        if not os.path.exists(os.path.join(directory, 'slideshow.mp4')):
             raise Exception('Something went wrong with piecing the slideshow together')
 
-        with open(os.path.join(directory, f'temp_{video.id}.mp4'), 'rb') as f:
-            ret = io.BytesIO(f.read())
+    async def _clean_url(self, url: str) -> str:
+        if url.startswith('https://vm.') or url.startswith('https://www.tiktok.com/t/'):
+            return await resolver.resolver.resolve(url=url, is_canonical=lambda u: bool(video_id_pattern.search(u)))
+        return url
 
-        for file in generated_files:
-            os.remove(file)
 
-        return ret
+async def _download_to_file(url: str, path: str, cookies: typing.Dict[str, str]) -> None:
+    async with base.SessionSingleton.get_instance().get(url=url, cookies=cookies, headers=headers) as resp:
+        with open(path, 'wb') as f:
+            async for chunk in resp.content.iter_chunked(base.CHUNK_SIZE):
+                f.write(chunk)
 
-    def _clean_url(self, url: str) -> str:
-        clean_url = url
-        if url.startswith('https://vm.') or url.startswith('https://www.tiktok.com/t/'):
-            response = requests.get(
-                url,
-                {
-                    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) '
-                    'AppleWebKit/537.36 (KHTML, like Gecko) '
-                    'Chrome/39.0.2171.95 Safari/537.36'
-                },
-            )
-            clean_url = response.url
-        return clean_url
+
+def _touch(path: str) -> bool:
+    """
+    Marks a cached file as used so it is not evicted while a job still needs it. Returns False if it is missing.
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _evict_expired(directory: str) -> typing.List[str]:
+    """
+    Removes files not used within TIKTOK_CACHE_TTL and returns their names.
+    """
+    expired = time.time() - TIKTOK_CACHE_TTL
+    evicted = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.stat().st_mtime < expired:
+            os.remove(entry.path)
+            evicted.append(entry.name)
+    return evicted
+
+
+os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+audio_tracks = AudioTrackCache(directory=AUDIO_CACHE_DIR)
+_render_locks = KeyedLocks()
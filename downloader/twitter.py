@@ -1,14 +1,27 @@
+import asyncio
 import datetime
+import functools
 import json
 import logging
 import os
+import time
 import typing
 
 import twscrape
 
+import metrics
 import models
 from downloader import base
 
+TWITTER_HEDGE = (os.getenv('TWITTER_HEDGE') or 'true').lower() == 'true'
+TWITTER_HEDGE_PERCENTILE = float(os.getenv('TWITTER_HEDGE_PERCENTILE') or 95)
+TWITTER_HEDGE_DELAY = float(os.getenv('TWITTER_HEDGE_DELAY') or 2.0)
+MIN_HEDGE_SAMPLES = 20
+MIN_HEDGE_DELAY = 0.25
+ROTATION_REFRESH_INTERVAL = 30
+RELOGIN_BACKOFF = 60
+MAX_RELOGIN_BACKOFF = 6 * 60 * 60
+
 scrape_url = 'https://cdn.syndication.twimg.com/tweet-result'
 headers = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:109.0) Gecko/20100101 Firefox/114.0',
@@ -27,30 +40,114 @@ headers = {
 }
 
 
+class TwitterAccountRotation(object):
+    """
+    Hands out cached cookies of active accounts for media downloads, least recently used and not rate limited first.
+    twscrape picks the account for API calls itself. Accounts that get locked out are taken out of rotation and
+    relogged in the background, backing off exponentially while relogging keeps failing.
+    """
+
+    def __init__(self) -> None:
+        self.accounts: typing.Dict[str, twscrape.Account] = {}
+        self.last_used: typing.Dict[str, float] = {}
+        self._relogins: typing.Dict[str, asyncio.Task] = {}
+        self._relogin_attempts: typing.Dict[str, int] = {}
+        self._next_relogin: typing.Dict[str, float] = {}
+        self._refreshed = 0.0
+
+    async def refresh(self, api: twscrape.API) -> None:
+        self._refreshed = time.monotonic()
+        accounts = await api.pool.get_all()
+        self.accounts = {account.username: account for account in accounts if account.active}
+        metrics.gauge('twitter.accounts.active', len(self.accounts))
+
+        now = time.monotonic()
+        for account in accounts:
+            username = account.username
+            if account.active:
+                self._relogin_attempts.pop(username, None)
+                self._next_relogin.pop(username, None)
+            elif username not in self._relogins and now >= self._next_relogin.get(username, 0):
+                attempts = self._relogin_attempts.get(username, 0)
+                self._relogin_attempts[username] = attempts + 1
+                self._next_relogin[username] = now + min(RELOGIN_BACKOFF * 2**attempts, MAX_RELOGIN_BACKOFF)
+                logging.warning(
+                    f'Twitter account {username} is locked out, relogging in the background (attempt {attempts + 1})'
+                )
+                self._relogins[username] = asyncio.create_task(self._relogin(api=api, username=username))
+
+    async def refresh_if_stale(self, api: twscrape.API) -> None:
+        """
+        Rate limit locks are only known from the pool, so they are reloaded every ROTATION_REFRESH_INTERVAL seconds.
+        """
+        if time.monotonic() - self._refreshed >= ROTATION_REFRESH_INTERVAL:
+            await self.refresh(api=api)
+
+    def acquire(self) -> typing.Optional[typing.Dict[str, str]]:
+        if not self.accounts:
+            return None
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        username = min(
+            self.accounts,
+            key=lambda u: (
+                any(lock > now for lock in self.accounts[u].locks.values()),
+                self.last_used.get(u, 0),
+            ),
+        )
+        self.last_used[username] = time.monotonic()
+        return self.accounts[username].cookies
+
+    async def wait_for_relogins(self) -> None:
+        await asyncio.gather(*self._relogins.values(), return_exceptions=True)
+
+    async def _relogin(self, api: twscrape.API, username: str) -> None:
+        try:
+            await api.pool.relogin(usernames=[username])
+            await self.refresh(api=api)
+        except Exception as e:
+            logging.error(f'Failed relogging twitter account {username}: {str(e)}')
+        finally:
+            self._relogins.pop(username, None)
+
+
 class TwitterClientSingleton(object):
     INSTANCE: typing.Optional[twscrape.API] = None
+    ROTATION = TwitterAccountRotation()
+    LOCK = asyncio.Lock()
 
     @classmethod
     async def get_instance(cls) -> typing.Optional[twscrape.API]:
-        username = os.getenv('TWITTER_USERNAME')
-        email = os.getenv('TWITTER_EMAIL')
-        password = os.getenv('TWITTER_PASSWORD')
-        if not all([username, email, password]):
+        accounts = _configured_accounts()
+        if not accounts:
             return None
 
-        if not cls.INSTANCE:
-            cls.INSTANCE = twscrape.API()
-            await cls.INSTANCE.pool.add_account(
-                username=username, email=email, password=password, email_password=password
-            )
-            await cls.INSTANCE.pool.login_all()
+        async with cls.LOCK:
+            if not cls.INSTANCE:
+                instance = twscrape.API()
+                for username, email, password in accounts:
+                    await instance.pool.add_account(
+                        username=username, email=email, password=password, email_password=password
+                    )
+                await instance.pool.login_all()
+                await cls.ROTATION.refresh(api=instance)
+                cls.INSTANCE = instance
 
+        await cls.ROTATION.refresh_if_stale(api=cls.INSTANCE)
         return cls.INSTANCE
 
     @classmethod
     async def relogin(cls) -> None:
         if cls.INSTANCE:
-            await cls.INSTANCE.pool.relogin(usernames=[os.getenv('TWITTER_USERNAME')])
+            await cls.ROTATION.refresh(api=cls.INSTANCE)
+            if not cls.ROTATION.accounts:
+                await cls.ROTATION.wait_for_relogins()
+
+
+class FetchedTweet(typing.NamedTuple):
+    post: models.Post
+    media_urls: typing.List[str]
+    cookies: typing.Optional[typing.Dict[str, str]] = None
 
 
 class TwitterClient(base.BaseClient):
@@ -60,19 +157,83 @@ class TwitterClient(base.BaseClient):
         super(TwitterClient, self).__init__(url=url)
         metadata = url.split('/status/')[-1].split('?')[0].split('/')
         self.id = metadata[0]
-        self.index = int(metadata[2]) - 1 if len(metadata) == 3 and metadata[1] == 'photo' else 0
+        is_photo_link = len(metadata) == 3 and metadata[1] == 'photo'
+        self.index = int(metadata[2]) - 1 if is_photo_link else 0
+        self.all_media = self.all_media and not is_photo_link
+
+    @property
+    def canonical_id(self) -> typing.Optional[str]:
+        return f'twitter:{self.id}:{"all" if self.all_media else self.index}'
+
+    @classmethod
+    async def warm_up(cls) -> bool:
+        client = await TwitterClientSingleton.get_instance()
+        if not client:
+            return False
+
+        if not any(account['active'] for account in await client.pool.accounts_info()):
+            raise Exception('No active twitter accounts')
+
+        return True
 
     async def get_post(self) -> models.Post:
         client = await TwitterClientSingleton.get_instance()
         if not client:
-            return await self._get_post_no_login()
+            tweet = await self._fetch_no_login()
+        elif not TWITTER_HEDGE:
+            tweet = await self._fetch_login(client=client)
+        else:
+            tweet = await self._fetch_hedged(client=client)
+
+        await self._publish_metadata(tweet.post)
+        tweet.post.buffers = await self._download_all(urls=tweet.media_urls, cookies=tweet.cookies)
+        return tweet.post
+
+    async def _fetch_hedged(self, client: twscrape.API) -> FetchedTweet:
+        """
+        Starts the syndication path as well if the logged in path is slower than its usual latency percentile.
+        Only the metadata requests race, whichever succeeds first wins and the other one is cancelled.
+        """
+        metrics.increment('twitter.hedge.requests')
+        primary = asyncio.create_task(self._fetch_login_timed(client=client))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=_hedge_delay())
+            if done and not primary.exception():
+                metrics.increment('twitter.hedge.login.wins')
+                return primary.result()
+
+            metrics.increment('twitter.hedge.started')
+            secondary = asyncio.create_task(self._fetch_no_login())
+            pending.add(secondary)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if not task.exception():
+                        metrics.increment(f'twitter.hedge.{"login" if task is primary else "no_login"}.wins')
+                        return task.result()
+        finally:
+            for task in pending:
+                task.cancel()
 
-        return await self._get_post_login(client=client)
+        raise secondary.exception()
 
-    async def _get_post_login(self, client: twscrape.API, retry_count=0) -> models.Post:
+    async def _fetch_login_timed(self, client: twscrape.API) -> FetchedTweet:
+        start = time.monotonic()
+        try:
+            tweet = await self._fetch_login(client=client, fallback=False)
+        except asyncio.CancelledError:
+            # Lost the hedge, the elapsed time is a lower bound of the real latency but keeps the slow tail sampled
+            metrics.observe('twitter.login.latency', time.monotonic() - start)
+            raise
+
+        metrics.observe('twitter.login.latency', time.monotonic() - start)
+        return tweet
+
+    async def _fetch_login(self, client: twscrape.API, retry_count=0, fallback: bool = True) -> FetchedTweet:
         try:
             details = await client.tweet_details(int(self.id))
-            p = models.Post(
+            post = models.Post(
                 url=self.url,
                 author=f'{details.user.displayname} ({details.user.username})',
                 description=details.rawContent,
@@ -81,31 +242,36 @@ class TwitterClient(base.BaseClient):
                 created=details.date.astimezone(),
             )
 
-            if not details.media:
-                return p
-
-            if details.media.videos:
-                url = max(details.media.videos[0].variants, key=lambda x: x.bitrate).url
-            elif details.media.photos:
-                url = details.media.photos[0].url
-            elif details.media.animated:
-                url = details.media.animated[0].videoUrl
-            else:
-                return p
+            urls = []
+            if details.media:
+                urls = (
+                    [
+                        self._select_variant(video.variants, bitrate=lambda x: x.bitrate).url
+                        for video in details.media.videos
+                    ]
+                    + [photo.url for photo in details.media.photos]
+                    + [animated.videoUrl for animated in details.media.animated]
+                )
+            if urls and not self.all_media:
+                urls = [urls[self.index if self.index < len(urls) else 0]]
 
-            p.buffer = await self._download(url=url, cookies=(await client.pool.get_all())[0].cookies)
-            return p
+            return FetchedTweet(post=post, media_urls=urls, cookies=TwitterClientSingleton.ROTATION.acquire())
         except Exception as e:
             logging.error(f'Failed fetching from twitter, retrying: {str(e)}')
             if retry_count == 0:
                 await TwitterClientSingleton.relogin()
-                return await self._get_post_login(client=client, retry_count=retry_count + 1)
-            elif retry_count == 1:
-                return await self._get_post_no_login()
+                return await self._fetch_login(client=client, retry_count=retry_count + 1, fallback=fallback)
+            elif retry_count == 1 and fallback:
+                return await self._fetch_no_login()
             else:
                 raise Exception('Failed fetching from twitter')
 
-    async def _get_post_no_login(self) -> models.Post:
+    def _select_variant(self, variants: typing.List[typing.Any], bitrate: typing.Callable) -> typing.Any:
+        if self.low_bitrate:
+            return min([variant for variant in variants if bitrate(variant)] or variants, key=bitrate)
+        return max(variants, key=bitrate)
+
+    async def _fetch_no_login(self) -> FetchedTweet:
         tweet = json.loads(
             await self._fetch_content(url=scrape_url, data='', headers=headers, params={'id': self.id, 'lang': 'en'})
         )
@@ -121,15 +287,51 @@ class TwitterClient(base.BaseClient):
             created=datetime.datetime.fromisoformat(tweet.get('created_at')).astimezone(),
         )
 
+        urls = []
         media_details = tweet.get('mediaDetails')
         if media_details:
-            media = media_details[self.index if self.index < len(media_details) else 0]
-            if media.get('type') == 'photo':
-                post.buffer = await self._download(url=media.get('media_url_https'))
-            elif media.get('type') == 'video':
-                video = max(media.get('video_info').get('variants'), key=lambda v: v.get('bitrate', 0))
-                post.buffer = await self._download(url=video.get('url'))
+            if not self.all_media:
+                media_details = [media_details[self.index if self.index < len(media_details) else 0]]
+
+            for media in media_details:
+                if media.get('type') == 'photo':
+                    urls.append(media.get('media_url_https'))
+                elif media.get('type') == 'video':
+                    video = self._select_variant(
+                        media.get('video_info').get('variants'), bitrate=lambda v: v.get('bitrate', 0)
+                    )
+                    urls.append(video.get('url'))
         elif 'user' in tweet and 'profile_image_url_https' in tweet.get('user'):
-            post.buffer = await self._download(url=tweet.get('user').get('profile_image_url_https'))
+            urls.append(tweet.get('user').get('profile_image_url_https'))
+
+        return FetchedTweet(post=post, media_urls=urls)
+
+
+def _hedge_delay() -> float:
+    if len(metrics.samples('twitter.login.latency')) < MIN_HEDGE_SAMPLES:
+        return TWITTER_HEDGE_DELAY
+
+    return max(metrics.percentile('twitter.login.latency', TWITTER_HEDGE_PERCENTILE), MIN_HEDGE_DELAY)
+
+
+@functools.lru_cache(maxsize=1)
+def _configured_accounts() -> typing.List[typing.Tuple[str, str, str]]:
+    accounts = []
+
+    username = os.getenv('TWITTER_USERNAME')
+    email = os.getenv('TWITTER_EMAIL')
+    password = os.getenv('TWITTER_PASSWORD')
+    if all([username, email, password]):
+        accounts.append((username, email, password))
+
+    for i, account in enumerate((os.getenv('TWITTER_ACCOUNTS') or '').split(',')):
+        if not account.strip():
+            continue
+
+        credentials = account.strip().split(':', 2)
+        if len(credentials) != 3 or not all(credentials):
+            logging.error(f'Skipping malformed TWITTER_ACCOUNTS entry {i + 1}, expected username:email:password')
+            continue
+        accounts.append((credentials[0], credentials[1], credentials[2]))
 
-        return post
+    return accounts
@@ -1,8 +1,7 @@
-import io
-
 import pytube
 from pytube.innertube import _default_clients
 
+import memory
 import models
 from downloader import base
 
@@ -23,11 +22,16 @@ class YoutubeClient(base.BaseClient):
             description=vid.title,
             views=vid.views,
             created=vid.publish_date,
-            buffer=io.BytesIO(),
         )
+        await self._publish_metadata(post)
+
+        if self.metadata_only:
+            return post
 
-        vid.streams.filter(progressive=True, file_extension='mp4').order_by(
-            'resolution'
-        ).desc().first().stream_to_buffer(post.buffer)
+        streams = vid.streams.filter(progressive=True, file_extension='mp4').order_by('resolution')
+        stream = streams.asc().first() if self.low_bitrate else streams.desc().first()
+        post.buffer = memory.accountant.allocate(size_hint=stream.filesize)
+        stream.stream_to_buffer(post.buffer)
+        post.buffer.seek(0)
 
         return post
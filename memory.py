@@ -0,0 +1,102 @@
+import asyncio
+import io
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import typing
+
+import metrics
+
+
+MEDIA_MEMORY_BUDGET = int(os.getenv('MEDIA_MEMORY_BUDGET') or 256 * 1024 * 1024)
+MEDIA_SPILL_DIR = os.getenv('MEDIA_SPILL_DIR') or tempfile.gettempdir()
+
+
+class MediaBuffer(io.BytesIO):
+    """
+    In-memory media buffer whose size is charged to the accountant until it is closed or garbage collected.
+    """
+
+    def __init__(self, accountant: 'MediaMemoryAccountant') -> None:
+        super().__init__()
+        self._accountant = accountant
+        self._accounted = 0
+
+    def write(self, b: typing.Any) -> int:
+        written = super().write(b)
+        size = max(self._accounted, self.tell())
+        if size > self._accounted:
+            self._accountant._charge(size - self._accounted)
+            self._accounted = size
+        return written
+
+    def close(self) -> None:
+        if not self.closed:
+            self._accountant._release(self._accounted)
+            self._accounted = 0
+        super().close()
+
+
+class MediaMemoryAccountant(object):
+    """
+    Tracks the bytes of media held in memory by all in-flight jobs.
+    Once the budget is reached new buffers are spilled to disk and new jobs wait for capacity.
+    """
+
+    def __init__(self, budget: int, spill_dir: str) -> None:
+        self.budget = budget
+        self.spill_dir = spill_dir
+        self.in_use = 0
+
+        self._lock = threading.Lock()
+        self._has_capacity = asyncio.Event()
+        self._has_capacity.set()
+        self._loop: typing.Optional[asyncio.AbstractEventLoop] = None
+
+    def allocate(self, size_hint: int = 0) -> typing.BinaryIO:
+        if self.in_use + size_hint > self.budget:
+            metrics.increment('media.memory.spilled')
+            return tempfile.TemporaryFile(dir=self.spill_dir)
+
+        return MediaBuffer(accountant=self)
+
+    def from_bytes(self, data: bytes) -> typing.BinaryIO:
+        buffer = self.allocate(size_hint=len(data))
+        buffer.write(data)
+        buffer.seek(0)
+        return buffer
+
+    def from_file(self, path: str) -> typing.BinaryIO:
+        buffer = self.allocate(size_hint=os.path.getsize(path))
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, buffer)
+        buffer.seek(0)
+        return buffer
+
+    async def wait_for_capacity(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        if self.in_use >= self.budget:
+            logging.info(f'Media memory budget exhausted ({self.in_use}/{self.budget} bytes), waiting...')
+            metrics.increment('media.memory.waits')
+
+        while self.in_use >= self.budget:
+            self._has_capacity.clear()
+            await self._has_capacity.wait()
+
+    def _charge(self, size: int) -> None:
+        with self._lock:
+            self.in_use += size
+        metrics.gauge('media.memory.in_use_bytes', self.in_use)
+
+    def _release(self, size: int) -> None:
+        with self._lock:
+            self.in_use -= size
+        metrics.gauge('media.memory.in_use_bytes', self.in_use)
+
+        if self.in_use < self.budget and self._loop and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._has_capacity.set)
+
+
+accountant = MediaMemoryAccountant(budget=MEDIA_MEMORY_BUDGET, spill_dir=MEDIA_SPILL_DIR)
@@ -0,0 +1,56 @@
+import asyncio
+import collections
+import json
+import logging
+import typing
+
+
+_counters: typing.DefaultDict[str, int] = collections.defaultdict(int)
+_gauges: typing.Dict[str, float] = {}
+_samples: typing.DefaultDict[str, typing.Deque[float]] = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+
+
+def increment(name: str, value: int = 1) -> None:
+    _counters[name] += value
+
+
+def gauge(name: str, value: float) -> None:
+    _gauges[name] = value
+
+
+def observe(name: str, value: float) -> None:
+    _samples[name].append(value)
+
+
+def samples(name: str) -> typing.List[float]:
+    return list(_samples.get(name, ()))
+
+
+def percentile(name: str, q: float) -> typing.Optional[float]:
+    values = sorted(_samples.get(name, ()))
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+def snapshot() -> typing.Dict[str, typing.Any]:
+    return {
+        'counters': dict(_counters),
+        'gauges': dict(_gauges),
+        'timings': {
+            name: {
+                'count': len(values),
+                'p50': percentile(name, 50),
+                'p95': percentile(name, 95),
+                'max': max(values),
+            }
+            for name, values in _samples.items()
+            if values
+        },
+    }
+
+
+async def report_forever(interval: float) -> typing.NoReturn:
+    while True:
+        await asyncio.sleep(interval)
+        logging.info(f'Metrics: {json.dumps(snapshot())}')
@@ -1,8 +1,8 @@
 import datetime
 import os
-import io
 import typing
 from dataclasses import dataclass
+from dataclasses import field
 
 
 @dataclass
@@ -12,10 +12,11 @@ class Post:
     description: typing.Optional[str] = None
     views: typing.Optional[int] = None
     likes: typing.Optional[int] = None
-    buffer: typing.Optional[io.BytesIO] = None
+    buffer: typing.Optional[typing.BinaryIO] = None
     spoiler: bool = False
     created: typing.Optional[datetime.datetime] = None
-    compact_post = os.environ.get('COMPACT_POST') or 'false'
+    gallery: typing.List[typing.BinaryIO] = field(default_factory=list)
+    compact_post = (os.environ.get('COMPACT_POST') or 'false').lower() == 'true'
 
     def __str__(self) -> str:
         description = self.description or '❌'
@@ -39,6 +40,15 @@ class Post:
             likes=self._number_human_format(num=self.likes) if self.likes else '❌',
         )
 
+    @property
+    def buffers(self) -> typing.List[typing.BinaryIO]:
+        return ([self.buffer] if self.buffer else []) + self.gallery
+
+    @buffers.setter
+    def buffers(self, buffers: typing.List[typing.BinaryIO]) -> None:
+        self.buffer = buffers[0] if buffers else None
+        self.gallery = buffers[1:]
+
     def _number_human_format(self, num: int) -> str:
         num = float('{:.3g}'.format(num))
         magnitude = 0
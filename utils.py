@@ -1,34 +1,53 @@
 import asyncio
-import io
 import mimetypes
 import random
 import re
+import shutil
 import tempfile
 import typing
 
 import magic
 
+import memory
+import metrics
+
 emoji = ['😼', '😺', '😸', '😹', '😻', '🙀', '😿', '😾', '😩', '🙈', '🙉', '🙊', '😳']
 
 
+ffmpeg_backlog = 0
+video_extensions = {'.mp4', '.webm', '.mov', '.mkv'}
+url_pattern = re.compile(r'https?://[^\s]+')
+
+
 def find_first_url(string: str) -> typing.Optional[str]:
-    urls = re.findall(r'(https?://[^\s]+)', string)
-    return urls[0] if urls else None
+    match = url_pattern.search(string)
+    return match.group(0) if match else None
+
+
+def find_all_urls(string: str) -> typing.List[str]:
+    return list(dict.fromkeys(url_pattern.findall(string)))
 
 
-def guess_extension_from_buffer(buffer: io.BytesIO) -> str:
+def buffer_size(buffer: typing.BinaryIO) -> int:
+    position = buffer.tell()
+    size = buffer.seek(0, 2)
+    buffer.seek(position)
+    return size
+
+
+def guess_extension_from_buffer(buffer: typing.BinaryIO) -> str:
     extension = mimetypes.guess_extension(type=magic.from_buffer(buffer.read(2048), mime=True))
     buffer.seek(0)
     return extension or '.mp4'
 
 
-async def resize(buffer: io.BytesIO, extension: str = 'mp4') -> io.BytesIO:
+async def resize(buffer: typing.BinaryIO, extension: str = 'mp4') -> typing.BinaryIO:
     with (
         tempfile.NamedTemporaryFile(suffix=extension) as input_tmp,
         tempfile.NamedTemporaryFile(suffix=extension) as output_tmp,
     ):
-        # with open('/tmp/temp', 'w+b') as tmp:
-        input_tmp.write(buffer.read())
+        shutil.copyfileobj(buffer, input_tmp)
+        input_tmp.flush()
 
         command = [
             'ffmpeg',
@@ -41,14 +60,72 @@ async def resize(buffer: io.BytesIO, extension: str = 'mp4') -> io.BytesIO:
             '-crf 28',
             f'{output_tmp.name}',
         ]
+        await run_ffmpeg(command=command)
+
+        return memory.accountant.from_file(output_tmp.name)
+
+
+async def run_ffmpeg(command: typing.List[str]) -> int:
+    global ffmpeg_backlog
+
+    ffmpeg_backlog += 1
+    metrics.gauge('ffmpeg.backlog', ffmpeg_backlog)
+    try:
         ffmpeg_proc = await asyncio.create_subprocess_shell(
             ' '.join(command),
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE,
         )
         await ffmpeg_proc.communicate()
+        return ffmpeg_proc.returncode
+    finally:
+        ffmpeg_backlog -= 1
+        metrics.gauge('ffmpeg.backlog', ffmpeg_backlog)
+
+
+async def probe_duration(path: str) -> float:
+    ffprobe_proc = await asyncio.create_subprocess_exec(
+        'ffprobe',
+        '-v',
+        'error',
+        '-show_entries',
+        'format=duration',
+        '-of',
+        'default=noprint_wrappers=1:nokey=1',
+        path,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, _ = await ffprobe_proc.communicate()
+    return float(stdout.decode().strip())
+
+
+async def fit_to_budget(
+    buffers: typing.List[typing.BinaryIO],
+    budget: int,
+    allow_resize: bool = True,
+) -> typing.List[typing.BinaryIO]:
+    """
+    Resizes videos larger than their share of the budget and drops trailing items until the whole set fits.
+    Without resizing, items are dropped until the set fits, possibly leaving none.
+    """
+    sizes = [buffer_size(buffer) for buffer in buffers]
+    if sum(sizes) <= budget:
+        return buffers
+
+    share = budget // len(buffers)
+    for i, buffer in enumerate(buffers):
+        extension = guess_extension_from_buffer(buffer=buffer)
+        if allow_resize and sizes[i] > share and extension in video_extensions:
+            buffers[i] = await resize(buffer=buffer, extension=extension)
+            buffer.close()
+            sizes[i] = buffer_size(buffers[i])
+
+    while len(buffers) > int(allow_resize) and sum(sizes) > budget:
+        buffers.pop().close()
+        sizes.pop()
 
-        return io.BytesIO(output_tmp.read())
+    return buffers
 
 
 def random_emoji() -> str: